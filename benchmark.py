@@ -0,0 +1,344 @@
+import argparse
+import builtins
+import contextlib
+import cv2
+import datetime
+import importlib.util
+import json
+import multiprocessing
+import numpy as np
+import os
+import piexif
+import platform
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+parser = argparse.ArgumentParser()
+parser.add_argument("directory", nargs="?", help="a directory of JPEG images to benchmark, a synthetic corpus is generated if omitted")
+parser.add_argument("--count", type=int, default=20, help="the number of synthetic 12MP images to generate")
+parser.add_argument("--suite", action='store_true', help="time every stage of image-ai.py and rename.py on synthetic libraries instead")
+parser.add_argument("--sizes", default="1000,10000,100000", help="a comma separated list of library sizes in files for the suite")
+parser.add_argument("--image-size", default="1600x1200", help="the dimensions of the synthetic photos in the suite")
+parser.add_argument("--corpus", help="an optional directory to keep the synthetic libraries in and reuse on later runs")
+parser.add_argument("--jobs", type=int, default=1, help="the number of processes rebuild_index hashes files with")
+parser.add_argument("--threads", type=int, default=8, help="the number of threads used to read EXIF metadata and move files")
+parser.add_argument("--output", help="the JSON file to save the suite results to, benchmark-YYYYmmdd_HHMMSS.json by default")
+parser.add_argument("--baseline", help="an optional JSON file from an earlier run to compare the throughput of each stage with")
+
+root = os.path.dirname(os.path.abspath(__file__))
+
+# Function to load one of the scripts as a module, image-ai.py can't be imported by name
+# because of the hyphen. The module is registered under its name so the worker processes of a
+# pool can unpickle the functions sent to them.
+def load_script(name, filename):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(root, filename))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+def load_image_ai():
+    return load_script("image_ai", "image-ai.py")
+
+# Function to load image-ai.py with its index and caches open, as its main block does
+def open_image_ai():
+    module = load_image_ai()
+    module.index = module.open_index(module.index_db)
+    module.metadata_cache = module.MetadataCache(module.index)
+    module.thumbnail_cache = module.ThumbnailCache(module.index, module.thumbnail_db)
+    return module
+
+# Function to return the peak resident memory of this process in MB
+def peak_rss():
+    # Linux carries ru_maxrss over from the parent across exec, VmHWM is this process only
+    if os.path.exists("/proc/self/status"):
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes on Linux
+    if sys.platform == "darwin":
+        return rss / (1024 * 1024)
+    return rss / 1024
+
+# Function to return the bytes this process has read through system calls and from storage,
+# None where /proc/self/io isn't available
+def bytes_read():
+    try:
+        with open("/proc/self/io") as f:
+            counters = dict(line.split(":") for line in f)
+        return int(counters['rchar']), int(counters['read_bytes'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+# The full resolution perceptual hash compute_phash used before the reduced decode
+def legacy_phash(file_path):
+    phash = {}
+    imread = cv2.imread(file_path, cv2.IMREAD_IGNORE_ORIENTATION)
+    imhash = cv2.img_hash.pHash(imread)
+    phash[0] = int.from_bytes(imhash.tobytes(), byteorder='big', signed=False)
+    imread = cv2.rotate(imread, cv2.ROTATE_90_CLOCKWISE)
+    imhash = cv2.img_hash.pHash(imread)
+    phash[1] = int.from_bytes(imhash.tobytes(), byteorder='big', signed=False)
+    imread = cv2.rotate(imread, cv2.ROTATE_180)
+    imhash = cv2.img_hash.pHash(imread)
+    phash[2] = int.from_bytes(imhash.tobytes(), byteorder='big', signed=False)
+    imread = cv2.rotate(imread, cv2.ROTATE_90_COUNTERCLOCKWISE)
+    imhash = cv2.img_hash.pHash(imread)
+    phash[3] = int.from_bytes(imhash.tobytes(), byteorder='big', signed=False)
+    return phash
+
+# Function to return a photo-like image, a smooth colour field with sensor noise
+def generate_image(rng, width, height):
+    image = cv2.resize((rng.random((30, 40, 3)) * 255).astype(np.uint8), (width, height), interpolation=cv2.INTER_CUBIC)
+    return np.clip(image + rng.normal(0, 8, image.shape), 0, 255).astype(np.uint8)
+
+# Function to write photo-like 12MP JPEGs
+def generate_corpus(directory, count):
+    rng = np.random.default_rng(0)
+    files = []
+    for i in range(count):
+        file_path = os.path.join(directory, f"{i:05d}.jpg")
+        cv2.imwrite(file_path, generate_image(rng, 4000, 3000))
+        files.append(file_path)
+    return files
+
+# The make up of every hundred files in a synthetic library. Copies are made of the last
+# original, the way exports and re-saves of a photo end up beside it.
+library_mix = ['original'] * 78 + ['duplicate'] * 5 + ['rotated'] * 5 + ['resized'] * 5 + ['recompressed'] * 5 + ['video'] * 2
+
+# Function to write a short clip of a panning colour field
+def generate_video(rng, file_path):
+    image = generate_image(rng, 320, 240)
+    writer = cv2.VideoWriter(file_path, cv2.VideoWriter_fourcc(*'mp4v'), 15, (160, 120))
+    for frame in range(30):
+        writer.write(cv2.resize(np.roll(image, frame * 4, axis=1), (160, 120), interpolation=cv2.INTER_AREA))
+    writer.release()
+
+# Function to generate a reproducible library of camera JPEGs with EXIF in YYYY/MM folders,
+# copies of them and short videos. A library which finished generating is reused.
+def generate_library(directory, count, width, height):
+    complete_path = os.path.join(directory, ".complete")
+    if os.path.exists(complete_path):
+        return
+    shutil.rmtree(directory, ignore_errors=True)
+    rng = np.random.default_rng(count)
+    image = None
+    original_path = None
+    start = datetime.datetime(2015, 1, 1)
+    for i in range(count):
+        kind = library_mix[i % len(library_mix)]
+        taken = start + datetime.timedelta(minutes=int(rng.integers(0, 10 * 365 * 24 * 60)))
+        folder = os.path.join(directory, taken.strftime('%Y'), taken.strftime('%m'))
+        os.makedirs(folder, exist_ok=True)
+        if kind == 'original' or image is None:
+            image = generate_image(rng, width, height)
+            original_path = os.path.join(folder, f"IMG_{i:06d}.JPG")
+            cv2.imwrite(original_path, image, [cv2.IMWRITE_JPEG_QUALITY, 92])
+            exif = piexif.dump({
+                '0th': {piexif.ImageIFD.Make: b"Synthetic", piexif.ImageIFD.Model: b"Benchmark", piexif.ImageIFD.Orientation: 1},
+                'Exif': {piexif.ExifIFD.DateTimeOriginal: taken.strftime('%Y:%m:%d %H:%M:%S').encode()}
+            })
+            piexif.insert(exif, original_path)
+        elif kind == 'duplicate':
+            shutil.copyfile(original_path, os.path.join(folder, f"IMG_{i:06d}_copy.JPG"))
+        elif kind == 'rotated':
+            cv2.imwrite(os.path.join(folder, f"IMG_{i:06d}_rotated.jpg"), cv2.rotate(image, cv2.ROTATE_90_CLOCKWISE))
+        elif kind == 'resized':
+            cv2.imwrite(os.path.join(folder, f"IMG_{i:06d}_resized.jpg"), cv2.resize(image, (width // 2, height // 2), interpolation=cv2.INTER_AREA))
+        elif kind == 'recompressed':
+            cv2.imwrite(os.path.join(folder, f"IMG_{i:06d}_recompressed.jpg"), image, [cv2.IMWRITE_JPEG_QUALITY, 60])
+        else:
+            generate_video(rng, os.path.join(folder, f"VID_{i:06d}.mp4"))
+    open(complete_path, "w").close()
+
+# Function to list the files of a library the way the scripts walk it
+def list_files(library):
+    from scanner import Scanner
+    return [entry.path for entry in Scanner().walk(library)]
+
+# Each stage sets up outside the timing and returns the function to time and the number of
+# files it processes. The stages share one home directory, so the index the rebuild writes is
+# the one the later stages read.
+def stage_compute_hash(library, options):
+    module = load_image_ai()
+    files = list_files(library)
+    return lambda: [module.compute_hash(file_path) for file_path in files], len(files)
+
+def stage_compute_phash(library, options):
+    module = load_image_ai()
+    images = [file_path for file_path in list_files(library) if module.is_image(file_path)]
+    return lambda: [module.compute_phash(file_path) for file_path in images], len(images)
+
+def stage_rebuild_index(library, options):
+    module = open_image_ai()
+    return lambda: module.rebuild_index(library, options['jobs'], options['threads']), len(list_files(library))
+
+def stage_hashmap_index(library, options):
+    module = open_image_ai()
+    count = module.index.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+    return lambda: module.hashmap_index(4), count
+
+def stage_dedupe_index(library, options):
+    module = open_image_ai()
+    count = module.index.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+    # Answer every prompt with ignore so the duplicate search runs without changing anything
+    builtins.input = lambda prompt="": ""
+    return module.dedupe_index, count
+
+def stage_rename(library, options):
+    # Rename a hard linked copy, the EXIF is rewritten into new files so the library is untouched
+    directory = os.path.join(os.path.expanduser("~"), "rename")
+    shutil.rmtree(directory, ignore_errors=True)
+    shutil.copytree(library, directory, copy_function=os.link)
+    sys.argv = ["rename.py", directory, "--threads", str(options['threads'])]
+    module = load_script("rename", "rename.py")
+    return module.main, len(list_files(directory))
+
+stages = {
+    'compute_hash': stage_compute_hash,
+    'compute_phash': stage_compute_phash,
+    'rebuild_index': stage_rebuild_index,
+    'hashmap_index': stage_hashmap_index,
+    'dedupe_index': stage_dedupe_index,
+    'rename': stage_rename
+}
+
+# The stages which read the index the rebuild writes, and are skipped when it fails
+index_stages = ('hashmap_index', 'dedupe_index')
+
+# Function to run one stage in a fresh process, so the peak memory and bytes read of one
+# stage don't carry over to the next
+def run_stage(stage, library, home, options, results):
+    os.environ["HOME"] = home
+    # A spawned process inherits the spawn start method, restore the platform default so a
+    # hashing pool starts its workers as it does when image-ai.py is run
+    multiprocessing.set_start_method(None, force=True)
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+            run, items = stages[stage](library, options)
+            rchar, read_bytes = bytes_read()
+            start = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - start
+            end_rchar, end_read_bytes = bytes_read()
+    except Exception as e:
+        # Report the failure rather than leave the parent waiting for a result
+        results.put({'stage': stage, 'error': repr(e)})
+        return
+    results.put({
+        'stage': stage,
+        'items': items,
+        'seconds': elapsed,
+        'items_per_second': items / elapsed if elapsed else None,
+        'peak_rss_mb': peak_rss(),
+        'bytes_read': end_rchar - rchar if rchar is not None else None,
+        'storage_bytes_read': end_read_bytes - read_bytes if read_bytes is not None else None
+    })
+
+def benchmark_suite():
+    width, height = (int(value) for value in args.image_size.split("x"))
+    options = {'jobs': args.jobs, 'threads': args.threads}
+    corpus = args.corpus or tempfile.mkdtemp()
+    context = multiprocessing.get_context("spawn")
+    results = []
+    try:
+        for count in (int(size) for size in args.sizes.split(",")):
+            library = os.path.join(corpus, str(count))
+            print(f"Generating {count} files in {library}")
+            generate_library(library, count, width, height)
+            with tempfile.TemporaryDirectory() as home:
+                failed = set()
+                for stage in stages:
+                    if stage in index_stages and 'rebuild_index' in failed:
+                        results.append({'stage': stage, 'files': count, 'skipped': "rebuild_index failed"})
+                        print(f"{count:8} {stage:14} skipped: rebuild_index failed")
+                        continue
+                    queue = context.Queue()
+                    process = context.Process(target=run_stage, args=(stage, library, home, options, queue))
+                    process.start()
+                    result = queue.get()
+                    process.join()
+                    result['files'] = count
+                    results.append(result)
+                    if 'error' in result:
+                        failed.add(stage)
+                        print(f"{count:8} {stage:14} failed: {result['error']}")
+                        continue
+                    print(f"{count:8} {stage:14} {result['seconds']:9.2f} s {result['items_per_second']:9.1f} files/s {result['peak_rss_mb']:8.1f} MB peak")
+    finally:
+        if not args.corpus:
+            shutil.rmtree(corpus, ignore_errors=True)
+    output_path = args.output or "benchmark-" + datetime.datetime.now().strftime('%Y%m%d_%H%M%S') + ".json"
+    with open(output_path, "w") as output:
+        json.dump({
+            'timestamp': datetime.datetime.now().isoformat(),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'opencv': cv2.__version__,
+            'image_size': args.image_size,
+            'jobs': args.jobs,
+            'threads': args.threads,
+            'results': results
+        }, output, indent=2)
+    print(f"Results: {output_path}")
+    if args.baseline:
+        compare_results(args.baseline, results)
+
+# Function to print the change in throughput of each stage since an earlier run
+def compare_results(baseline_path, results):
+    with open(baseline_path) as baseline:
+        previous = {(result['files'], result['stage']): result for result in json.load(baseline)['results']}
+    for result in results:
+        before = previous.get((result['files'], result['stage']))
+        if before and before.get('items_per_second') and result.get('items_per_second'):
+            change = (result['items_per_second'] / before['items_per_second'] - 1) * 100
+            print(f"{result['files']:8} {result['stage']:14} {change:+8.1f}% files/s")
+
+# Function to hash every file with one implementation, run in a fresh process so the
+# peak memory of one implementation doesn't hide the other
+def run_phash(name, files, results):
+    if name == "legacy":
+        phash = legacy_phash
+    else:
+        compute_phash = load_image_ai().compute_phash
+        phash = lambda file_path: compute_phash(file_path)['phash']
+    baseline = peak_rss()
+    start = time.perf_counter()
+    hashes = [phash(file_path) for file_path in files]
+    elapsed = time.perf_counter() - start
+    results.put((hashes, elapsed, peak_rss() - baseline))
+
+def benchmark_phash(files):
+    context = multiprocessing.get_context("spawn")
+    measured = {}
+    for name in ("legacy", "reduced"):
+        results = context.Queue()
+        process = context.Process(target=run_phash, args=(name, files, results))
+        process.start()
+        measured[name] = results.get()
+        process.join()
+    for name, (_, elapsed, peak) in measured.items():
+        print(f"{name:8} {elapsed / len(files) * 1000:8.1f} ms/image {peak:8.1f} MB peak")
+    # Hamming distance between the legacy and reduced hash of each rotation
+    distances = [bin(a[r] ^ b[r]).count("1") for a, b in zip(measured["legacy"][0], measured["reduced"][0]) for r in range(4)]
+    print(f"distance max {max(distances)} median {statistics.median(distances)} bits")
+
+def main():
+    if args.suite:
+        benchmark_suite()
+    elif args.directory:
+        files = sorted(os.path.join(args.directory, f) for f in os.listdir(args.directory) if f.lower().endswith((".jpg", ".jpeg")))
+        benchmark_phash(files)
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            benchmark_phash(generate_corpus(directory, args.count))
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main()
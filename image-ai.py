@@ -1,28 +1,160 @@
 import argparse
 import cv2
+import datetime
+import dbm
 import hashlib
+import json
 import shelve
 import os
-import piexif
+import queue
 import shutil
-import uuid
+import sqlite3
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+from journal import Journal, undo_moves
+from metadata import MetadataCache, is_video
+from metrics import profile, stages
+from scanner import Scanner, ignored_names
+from thumbcache import ThumbnailCache, compute_features, is_image
 from tqdm import tqdm
 
+# The watch mode uses inotify on Linux when it's installed and scans directories otherwise
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
 parser = argparse.ArgumentParser()
 #parser.add_argument("directory", default='~', help="the directory containing the photos")
-parser.add_argument("-r", "--rebuild", action='store_true', help="empty and rebuild the index database")
+parser.add_argument("-r", "--rebuild", action='store_true', help="rebuild the index database from a walk of the library")
+parser.add_argument("--resume", action='store_true', help="continue an interrupted rebuild from the files it had already indexed")
+parser.add_argument("-u", "--update", action='store_true', help="incrementally update the index database with new, modified and deleted files")
 parser.add_argument("-d", "--dedupe", action='store_true', help="dedupe the index database")
+parser.add_argument("-b", "--batch", action='store_true', help="dedupe without prompting, using the policy to keep one file of each duplicate group")
+parser.add_argument("--policy", default="preferred,oldest,largest,shortest", help="a comma separated list of rules for the file to keep: preferred, oldest, largest, shortest")
+parser.add_argument("--prefer", help="an optional directory whose files are kept by the preferred policy")
+parser.add_argument("--undo", help="a dedupe journal whose moves to the trash directory are reversed")
+parser.add_argument("-w", "--watch", action='store_true', help="update the index database and keep it updated as files change in the library")
+parser.add_argument("--interval", type=int, default=60, help="the number of seconds between scans when watching a library inotify can't watch")
 parser.add_argument("-t", "--trash", help="an optional suffix for the trash directoy")
 parser.add_argument("-s", "--source", help="an optional suffix for the source directoy")
-args = parser.parse_args()
+parser.add_argument("-m", "--hashmap", action='store_true', help="report duplicate and near duplicate hashes in the index database")
+parser.add_argument("-n", "--dry-run", action='store_true', help="report what would be done without moving any files")
+parser.add_argument("--report", help="an optional JSON lines file to write the import or dedupe report to")
+parser.add_argument("-j", "--jobs", type=int, default=1, help="the number of processes used to hash files")
+parser.add_argument("--threads", type=int, default=8, help="the number of threads used to read EXIF metadata")
+parser.add_argument("--chunk-size", type=int, default=1024 * 1024, help="the number of bytes read at a time when hashing files")
+parser.add_argument("--cache-size", type=int, default=1024, help="the size cap of the thumbnail cache in MB")
+parser.add_argument("--ignore", default=",".join(ignored_names), help="a comma separated list of file and directory names to skip, besides hidden files")
+parser.add_argument("--extensions", help="an optional comma separated list of the only file extensions to index, such as .jpg,.heic")
+parser.add_argument("--include-hidden", action='store_true', help="index hidden files and directories")
+parser.add_argument("--metrics", help="an optional file to write per stage metrics to, Prometheus text if it ends in .prom and JSON lines otherwise")
+parser.add_argument("--profile", action='store_true', help="capture a cProfile profile and tracemalloc snapshot of the run in the home directory")
+parser.add_argument("--threshold", type=int, default=4, help="the maximum perceptual hash distance in bits for near duplicate images and videos")
 
 # Initialize the local database
-index_db = os.path.join(os.path.expanduser("~"), 'index')
-hashmap_db = os.path.join(os.path.expanduser("~"), 'hashmap')
+index_db = os.path.join(os.path.expanduser("~"), 'index.sqlite')
+shelve_db = os.path.join(os.path.expanduser("~"), 'index')
+thumbnail_db = os.path.join(os.path.expanduser("~"), 'thumbnails.bin')
 library = "/Volumes/home/Photos/PhotoLibrary"
-index = shelve.open(index_db)
-hashmap = shelve.open(hashmap_db)
+batch_size = 500
+chunk_size = 1024 * 1024
+partial_size = 64 * 1024
+video_frames = 8
+# Changed paths are indexed once they have been quiet for this many seconds
+debounce_time = 2
+watch_queue_size = 10000
+# The rules a dedupe policy is made of
+policy_rules = ('preferred', 'oldest', 'largest', 'shortest')
+# Filesystems whose changes made on other machines never reach inotify
+network_filesystems = ('nfs', 'nfs4', 'cifs', 'smbfs', 'smb3', 'afpfs', '9p')
 debug = True
+scanner = Scanner()
+
+# Function to open the index database and create the schema if it doesn't exist
+def open_index(path):
+    db = sqlite3.connect(path)
+    db.row_factory = sqlite3.Row
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.executescript("""
+        CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY,
+            filename TEXT,
+            extension TEXT,
+            size INTEGER,
+            mtime INTEGER,
+            inode INTEGER,
+            hash TEXT,
+            phash0 INTEGER,
+            phash1 INTEGER,
+            phash2 INTEGER,
+            phash3 INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS files_size ON files (size);
+        CREATE INDEX IF NOT EXISTS files_hash ON files (hash);
+        CREATE INDEX IF NOT EXISTS files_phash0 ON files (phash0);
+        CREATE INDEX IF NOT EXISTS files_phash1 ON files (phash1);
+        CREATE INDEX IF NOT EXISTS files_phash2 ON files (phash2);
+        CREATE INDEX IF NOT EXISTS files_phash3 ON files (phash3);
+        CREATE TABLE IF NOT EXISTS video_hashes (
+            path TEXT,
+            position INTEGER,
+            phash INTEGER,
+            PRIMARY KEY (path, position)
+        );
+        CREATE TABLE IF NOT EXISTS rebuild_journal (
+            path TEXT PRIMARY KEY
+        );
+        CREATE TRIGGER IF NOT EXISTS files_delete AFTER DELETE ON files BEGIN
+            DELETE FROM video_hashes WHERE path = OLD.path;
+        END;
+    """)
+    if db.execute("PRAGMA user_version").fetchone()[0] == 0:
+        migrate_shelve(db)
+        db.execute("PRAGMA user_version = 1")
+    return db
+
+# Function to copy the records from the old shelve index into the database
+def migrate_shelve(db):
+    if not dbm.whichdb(shelve_db):
+        return
+    print("├ Migrating " + shelve_db + " to " + index_db)
+    with shelve.open(shelve_db, flag='r') as old_index, db:
+        for value in old_index.values():
+            store_record(db, value)
+
+# SQLite integers are signed 64-bit so perceptual hashes are stored in two's complement
+def to_signed(value):
+    if value is not None and value >= 1 << 63:
+        return value - (1 << 64)
+    return value
+
+def to_unsigned(value):
+    if value is not None and value < 0:
+        return value + (1 << 64)
+    return value
+
+# Function to store an index record, replacing any existing record for the same path
+@stages.timed('store')
+def store_record(db, record):
+    phash = record.get('phash') or {}
+    db.execute(
+        "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (record['path'], record['filename'], record['extension'], record.get('size'), record.get('mtime'),
+         record.get('inode'), record['hash'], *(to_signed(phash.get(i)) for i in range(4))))
+    # Keep the features of a newly decoded image in the thumbnail cache, None means they were
+    # already cached so only their last use is updated
+    if 'features' in record:
+        if record['features'] is not None:
+            thumbnail_cache.put(record['hash'], record['features'])
+        else:
+            thumbnail_cache.touch(record['hash'])
+    if 'video_phash' in record:
+        db.execute("DELETE FROM video_hashes WHERE path = ?", (record['path'],))
+        db.executemany("INSERT INTO video_hashes VALUES (?, ?, ?)",
+                       [(record['path'], position, to_signed(phash)) for position, phash in enumerate(record['video_phash'] or [])])
 
 # Function to extract the file extention of a file
 def get_file_extension(filename):
@@ -34,157 +166,821 @@ def compute_hash(file_path):
     try:
         sha256_hash = hashlib.sha256()
         with open(file_path, "rb") as f:
-            for byte_block in iter(lambda: f.read(4096), b""):
-                sha256_hash.update(byte_block)
+            # Time reading and hashing apart to tell a slow disk or share from a slow CPU
+            while True:
+                start = time.perf_counter()
+                byte_block = f.read(chunk_size)
+                stages.record('read', time.perf_counter() - start, len(byte_block))
+                if not byte_block:
+                    break
+                with stages.time('sha256', len(byte_block)):
+                    sha256_hash.update(byte_block)
+        return sha256_hash.hexdigest()
+    except OSError as e:
+        print(e)
+        return None
+
+# Function to compute the SHA-256 hash of the first and last blocks of a file, a cheap
+# prefilter for files of the same size before hashing them in full
+def compute_partial_hash(file_path, size):
+    try:
+        sha256_hash = hashlib.sha256()
+        with stages.time('partial_hash', min(size, 2 * partial_size)), open(file_path, "rb") as f:
+            sha256_hash.update(f.read(partial_size))
+            if size > partial_size:
+                f.seek(max(partial_size, size - partial_size))
+                sha256_hash.update(f.read(partial_size))
         return sha256_hash.hexdigest()
-    except hashlib.exception as e:
+    except OSError as e:
         print(e)
         return None
 
-# Function to compute the perceptual hash of an image
+# Function to find identical files among (path, size, hash) tuples in stages. Files are
+# bucketed by size, then by the hash of their first and last blocks, and only files which
+# still collide are hashed in full. Hashes already in the index are reused and new ones are
+# cached there. Returns a dictionary of hash to the paths of two or more identical files.
+def find_duplicates(files):
+    by_size = {}
+    for file_path, size, file_hash in files:
+        by_size.setdefault(size, []).append((file_path, size, file_hash))
+    by_hash = {}
+    for size, group in by_size.items():
+        if len(group) < 2:
+            continue
+        by_partial = {}
+        for file_path, _, file_hash in group:
+            by_partial.setdefault(compute_partial_hash(file_path, size), []).append((file_path, file_hash))
+        for partial_hash, candidates in by_partial.items():
+            if partial_hash is None or len(candidates) < 2:
+                continue
+            for file_path, file_hash in candidates:
+                if file_hash is None:
+                    file_hash = compute_hash(file_path)
+                    index.execute("UPDATE files SET hash = ? WHERE path = ?", (file_hash, file_path))
+                if file_hash is not None:
+                    by_hash.setdefault(file_hash, []).append(file_path)
+    index.commit()
+    return {file_hash: paths for file_hash, paths in by_hash.items() if len(paths) > 1}
+
+# Function to compute the perceptual hash of an image and its three rotations, along with the
+# thumbnail, dimensions and colour histogram kept in the thumbnail cache. The image is decoded at
+# an eighth of its resolution and area-downscaled to the 32x32 input the pHash uses, so rotations
+# are done on the tiny matrix instead of the full frame. Hashes differ from a full resolution
+# decode by at most 6 bits (median 2) on benchmark.py's 12MP corpus, so run --rebuild after
+# upgrading to keep exact perceptual matches consistent.
 def compute_phash(file_path):
     try:
-        phash = {}
-        #imread = cv2.cvtColor(cv2.imread(file_path), cv2.IMREAD_IGNORE_ORIENTATION, cv2.COLOR_BGR2GRAY)
-        imread = cv2.imread(file_path, cv2.IMREAD_IGNORE_ORIENTATION)
-        imhash = cv2.img_hash.pHash(imread) # 8-byte hash
-        phash[0] = int.from_bytes(imhash.tobytes(), byteorder='big', signed=False)
-        imread = cv2.rotate(imread, cv2.ROTATE_90_CLOCKWISE)
-        imhash = cv2.img_hash.pHash(imread) # 8-byte hash
-        phash[1] = int.from_bytes(imhash.tobytes(), byteorder='big', signed=False)
-        imread = cv2.rotate(imread, cv2.ROTATE_180)
-        imhash = cv2.img_hash.pHash(imread) # 8-byte hash
-        phash[2] = int.from_bytes(imhash.tobytes(), byteorder='big', signed=False)
-        imread = cv2.rotate(imread, cv2.ROTATE_90_COUNTERCLOCKWISE)
-        imhash = cv2.img_hash.pHash(imread) # 8-byte hash
-        phash[3] = int.from_bytes(imhash.tobytes(), byteorder='big', signed=False)
-        return phash
+        return compute_features(file_path)
+    except cv2.error as e:
+        print(e)
+        return None
+
+# Function to compute the perceptual hashes of frames sampled evenly through a video. Each frame
+# is reached by seeking, which only decodes from the keyframe before it, so the cost of a clip
+# is bounded by the number of frames sampled rather than its duration.
+def compute_video_phash(file_path):
+    capture = cv2.VideoCapture(file_path)
+    try:
+        frame_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        if frame_count <= 0:
+            return None
+        phashes = []
+        for position in range(video_frames):
+            capture.set(cv2.CAP_PROP_POS_FRAMES, int((position + 0.5) * frame_count / video_frames))
+            ok, frame = capture.read()
+            if not ok:
+                break
+            imread = cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), (32, 32), interpolation=cv2.INTER_AREA)
+            imhash = cv2.img_hash.pHash(imread) # 8-byte hash
+            phashes.append(int.from_bytes(imhash.tobytes(), byteorder='big', signed=False))
+        return phashes or None
     except cv2.error as e:
         print(e)
         return None
+    finally:
+        capture.release()
 
 # function to check if an image was taken with a camera
 def is_camera(filename):
-    try:
-        exif_dict = piexif.load(filename)
-        if piexif.ImageIFD.Make in exif_dict['0th'] and piexif.ImageIFD.Model in exif_dict['0th']:
-            return True
-        else:
-            print(exif_dict)
-            return False
-    except Exception as e:
-        print(f"Error loading EXIF data: {e}")
-        return False
+    return metadata_cache.is_camera(filename)
+
+# Function to build the index record for a single file
+def index_file(file_path, stat, file_hash=None):
+    filename = os.path.basename(file_path)
+    file_ext = str.upper(get_file_extension(filename))
+    # Images are read in full for the perceptual hash anyway, other files are only hashed
+    # by find_duplicates when their size matches another file. Images are recognised by their
+    # magic bytes so HEIC, PNG and RAW files are hashed whatever their extension.
+    if is_image(file_path):
+        if file_hash is None:
+            file_hash = compute_hash(file_path)
+        # A copy of an image already in the thumbnail cache is never decoded again
+        with stages.time('thumbnail_cache'):
+            cached = thumbnail_cache.lookup(file_hash) if file_hash else None
+        stages.increment('thumbnail_cache_hits' if cached else 'thumbnail_cache_misses')
+        features = compute_phash(file_path) if cached is None else None
+        file_phash = (cached or features or {}).get('phash')
+    else:
+        file_phash = None
+        cached = features = None
+    record = {
+        'filename': filename,
+        'extension': file_ext,
+        'path': file_path,
+        'size': stat.st_size,
+        'mtime': stat.st_mtime_ns,
+        'inode': stat.st_ino,
+        'hash': file_hash,
+        'phash': file_phash
+    }
+    if file_hash is not None and (cached or features):
+        record['features'] = features
+    if is_video(file_path):
+        with stages.time('video_phash'):
+            record['video_phash'] = compute_video_phash(file_path)
+    return record
+
+# Function to check if an indexed file has metadata to extract. Only the images index_file
+# recognised are hashed as they're indexed, so the hash marks them whatever their extension.
+def has_metadata(record):
+    return record['hash'] is not None or is_video(record['path'])
+
+# Function to iterate through directories and files recursively in a single pass, skipping the
+# ignored names, and growing the total of an optional progress bar as directories are listed
+def walk_files(directory, pbar=None):
+    entries = scanner.walk(directory, pbar)
+    while True:
+        # Time the listing and stat of each file, but not the consumer's work between them
+        start = time.perf_counter()
+        entry = next(entries, None)
+        if entry is None:
+            return
+        try:
+            stat = entry.stat()
+        except OSError as e:
+            print(e)
+            scanner.failed.append(entry.path)
+            continue
+        stages.record('walk', time.perf_counter() - start)
+        yield entry.path, stat
+
+# Function to set up a hashing process with the options of the main process
+def init_worker(size, cache_size):
+    global chunk_size, thumbnail_cache
+    chunk_size = size
+    # Drop the metrics a forked worker inherits, it only sends back what it records itself
+    stages.collect(reset=True)
+    # Workers only read the thumbnail cache, new features are stored by the single writer
+    thumbnail_cache = ThumbnailCache(sqlite3.connect(index_db), thumbnail_db, cache_size, readonly=True)
+    # Keep OpenCV single threaded in each worker since the pool already uses every core
+    cv2.setNumThreads(1)
+
+# Function to index a file in a worker process, sending the metrics it recorded back with the
+# record so they're merged into the metrics of the main process
+def index_file_measured(file_path, stat):
+    record = index_file(file_path, stat)
+    record['metrics'] = stages.collect(reset=True)
+    return record
+
+def merge_metrics(record):
+    stages.merge(record.pop('metrics'))
+    return record
+
+# Function to hash files, in a process pool when more than one job is requested,
+# yielding index records as they complete so a single writer can store them
+def index_files(files, jobs=1):
+    if jobs <= 1:
+        for file_path, stat in files:
+            yield index_file(file_path, stat)
+        return
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(chunk_size, thumbnail_cache.max_bytes)) as executor:
+        pending = set()
+        for file_path, stat in files:
+            pending.add(executor.submit(index_file_measured, file_path, stat))
+            # Bound the work in flight so the whole library is never queued at once
+            if len(pending) >= jobs * 4:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield merge_metrics(future.result())
+        for future in as_completed(pending):
+            yield merge_metrics(future.result())
+
+# Function to count the bits which differ between two perceptual hashes
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+# BK-tree of perceptual hashes which finds every hash within a Hamming distance of a query
+# without comparing against the whole library https://en.wikipedia.org/wiki/BK-tree
+class BKTree:
+    def __init__(self):
+        # Each node is [hash, items, {distance: child}]
+        self.root = None
+
+    def add(self, phash, item):
+        if self.root is None:
+            self.root = [phash, [item], {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming_distance(phash, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [phash, [item], {}]
+                return
+            node = child
+
+    def search(self, phash, threshold):
+        results = []
+        nodes = [self.root] if self.root is not None else []
+        while nodes:
+            node = nodes.pop()
+            distance = hamming_distance(phash, node[0])
+            if distance <= threshold:
+                results.extend((distance, item) for item in node[1])
+            # Only subtrees within the threshold of this distance can hold matches
+            for child_distance, child in node[2].items():
+                if distance - threshold <= child_distance <= distance + threshold:
+                    nodes.append(child)
+        return results
+
+# Function to build a BK-tree of every rotation hash stored in the index
+def build_phash_tree():
+    tree = BKTree()
+    for row in index.execute("SELECT path, phash0, phash1, phash2, phash3 FROM files WHERE phash0 IS NOT NULL"):
+        for rotation in range(4):
+            tree.add(to_unsigned(row['phash' + str(rotation)]), row['path'])
+    return tree
+
+# Function to find the library images within the threshold of an upright perceptual hash,
+# the tree holds all four rotations so rotated copies are matched too
+def find_near_duplicates(tree, phash, threshold):
+    matches = {}
+    for distance, file_path in tree.search(phash, threshold):
+        if distance < matches.get(file_path, threshold + 1):
+            matches[file_path] = distance
+    return matches
+
+# Function to return the mean distance between the frames of two videos, None when they were
+# sampled differently
+def video_distance(phashes, other_phashes):
+    if len(phashes) != len(other_phashes):
+        return None
+    return sum(hamming_distance(a, b) for a, b in zip(phashes, other_phashes)) / len(phashes)
 
-def rebuild_index(directory):
-    index.clear()
-    # Iterate through directories and files recursively and exclude hidden
-    file_count = sum(len([f for f in files if not f[0] == '.']) for _, _, files in os.walk(directory))
-    with tqdm(total=file_count, ncols=100) as pbar:
-        for root, _, files in os.walk(directory):
-            files = [f for f in files if not f[0] == '.']
-            for filename in files:
+# Function to find the pairs of videos whose frames are within the threshold on average. A clip
+# can only be that close if one of its frames is within the threshold of the other's, so the
+# frames are searched in a BK-tree and only those candidates are compared in full.
+def find_near_duplicate_videos(threshold):
+    sequences = {}
+    for row in index.execute("SELECT path, phash FROM video_hashes ORDER BY path, position"):
+        sequences.setdefault(row['path'], []).append(to_unsigned(row['phash']))
+    tree = BKTree()
+    for file_path, phashes in sequences.items():
+        for phash in phashes:
+            tree.add(phash, file_path)
+    pairs = {}
+    for file_path, phashes in sequences.items():
+        candidates = {other for phash in phashes for _, other in tree.search(phash, threshold) if other > file_path}
+        for other in candidates:
+            distance = video_distance(phashes, sequences[other])
+            if distance is not None and distance <= threshold:
+                pairs[(file_path, other)] = distance
+    return pairs
+
+# Function to rebuild the index from a walk of the library. Every record is overwritten in place
+# rather than the index emptied first, and each file done is written to the rebuild journal in
+# the same transaction as its record, so a run which is interrupted loses at most the last batch
+# and --resume carries on from the journal. Records of files the walk didn't find are removed once
+# the rebuild is complete.
+def rebuild_index(directory, jobs=1, threads=8, resume=False):
+    if not resume:
+        index.execute("DELETE FROM rebuild_journal")
+    done = {row['path'] for row in index.execute("SELECT path FROM rebuild_journal")}
+    if done:
+        print("├ Resuming After: " + str(len(done)))
+    # Every path this walk found, including those done by the interrupted run
+    walked = set()
+    stored_count = 0
+    with tqdm(total=0, ncols=100) as pbar:
+        # Files done by the interrupted run are counted without being indexed again
+        def remaining():
+            for file_path, stat in walk_files(directory, pbar):
+                walked.add(file_path)
+                if file_path in done:
+                    pbar.update(1)
+                    continue
+                yield file_path, stat
+        try:
+            for record in index_files(remaining(), jobs):
                 pbar.update(1)
-                file_uuid = str(uuid.uuid4())
-                file_path = os.path.join(root, filename)
-                file_ext = str.upper(get_file_extension(filename))
-                file_hash = compute_hash(file_path)
-                if file_ext == ".JPG":
-                    file_phash = compute_phash(file_path)
+                # Store file information in the local database
+                store_record(index, record)
+                index.execute("INSERT OR IGNORE INTO rebuild_journal VALUES (?)", (record['path'],))
+                stored_count += 1
+                # Commit in batches rather than once per file
+                if stored_count % batch_size == 0:
+                    with stages.time('commit'):
+                        index.commit()
+        except KeyboardInterrupt:
+            index.commit()
+            print("\n├ Interrupted, run again with --rebuild --resume to continue")
+            raise
+    index.commit()
+    # A library which went away mid walk looks like a library of deleted files
+    if not os.path.isdir(directory):
+        print("├ Library unavailable, run again with --rebuild --resume to continue")
+        return
+    # Drop the files the walk didn't find, including any the interrupted run had indexed
+    removed = [(row['path'],) for row in index.execute("SELECT path FROM files") if row['path'] not in walked and not scanner.is_unlisted(row['path'])]
+    index.executemany("DELETE FROM files WHERE path = ?", removed)
+    index.executemany("DELETE FROM rebuild_journal WHERE path = ?", removed)
+    # The media indexed by the whole rebuild, including the run it resumed
+    media = [row['path'] for row in index.execute("SELECT path, hash FROM files JOIN rebuild_journal USING (path)") if has_metadata(row)]
+    index.execute("DELETE FROM rebuild_journal")
+    index.commit()
+    print("├ Removed: " + str(len(removed)))
+    print("├ Metadata Extracted: " + str(metadata_cache.extract(media, threads)))
+
+def update_index(directory, jobs=1, threads=8):
+    # An unmounted library looks like a library of deleted files
+    if not os.path.isdir(directory):
+        print("├ Library unavailable: " + directory)
+        return
+    # Map each indexed path to the stat signature recorded when it was hashed
+    indexed = {}
+    for row in index.execute("SELECT path, size, mtime, inode FROM files"):
+        indexed[row['path']] = (row['size'], row['mtime'], row['inode'])
+    seen = set()
+    with tqdm(total=0, ncols=100) as pbar:
+        # Skip files whose size, modification time and inode are unchanged
+        def changed_files():
+            for file_path, stat in walk_files(directory, pbar):
+                seen.add(file_path)
+                if indexed.get(file_path) == (stat.st_size, stat.st_mtime_ns, stat.st_ino):
+                    stages.increment('files_unchanged')
+                    pbar.update(1)
                 else:
-                    file_phash = None
+                    yield file_path, stat
+        added_count = 0
+        updated_count = 0
+        media = []
+        for record in index_files(changed_files(), jobs):
+            pbar.update(1)
+            if record['path'] in indexed:
+                updated_count += 1
+            else:
+                added_count += 1
+            store_record(index, record)
+            if has_metadata(record):
+                media.append(record['path'])
+            if (added_count + updated_count) % batch_size == 0:
+                with stages.time('commit'):
+                    index.commit()
+    # Drop entries for files which no longer exist in the library, keeping those below a
+    # directory the walk couldn't list
+    removed = [(file_path,) for file_path in indexed if file_path not in seen and not scanner.is_unlisted(file_path)]
+    index.executemany("DELETE FROM files WHERE path = ?", removed)
+    index.commit()
+    print("├ Added: " + str(added_count) + " Updated: " + str(updated_count) + " Removed: " + str(len(removed)))
+    print("├ Metadata Extracted: " + str(metadata_cache.extract(media, threads)))
+
+# Function to check if a directory is on a network filesystem, from the longest matching mount
+def is_network_mount(directory):
+    if not os.path.exists("/proc/mounts"):
+        return False
+    mount_point, fs_type = "", ""
+    with open("/proc/mounts") as mounts:
+        for line in mounts:
+            fields = line.split()
+            if (directory == fields[1] or directory.startswith(fields[1].rstrip(os.sep) + os.sep)) and len(fields[1]) > len(mount_point):
+                mount_point, fs_type = fields[1], fields[2]
+    return fs_type in network_filesystems or fs_type.startswith("fuse.")
+
+# Function to queue the paths inotify reports changed in a directory tree. Files are queued once
+# they are closed after writing, new directories are watched and their files queued, and a
+# directory is queued whenever events were lost so its entries are checked against the index.
+def watch_inotify(inotify, directory, events):
+    mask = flags.CLOSE_WRITE | flags.MOVED_TO | flags.MOVED_FROM | flags.DELETE | flags.CREATE
+    watches = {}
+    def add_watches(root, report):
+        for path in scanner.walk_directories(root):
+            try:
+                watches[inotify.add_watch(path, mask)] = path
+            except OSError as e:
+                print(e)
+            if report:
+                events.put(path)
+    add_watches(directory, False)
+    while True:
+        for event in inotify.read():
+            if event.mask & flags.Q_OVERFLOW:
+                for path in list(watches.values()):
+                    events.put(path)
+                continue
+            if event.mask & flags.IGNORED:
+                watches.pop(event.wd, None)
+                continue
+            parent = watches.get(event.wd)
+            if parent is None or scanner.is_ignored(event.name):
+                continue
+            path = os.path.join(parent, event.name)
+            if event.mask & flags.ISDIR and event.mask & (flags.CREATE | flags.MOVED_TO):
+                add_watches(path, True)
+            elif not event.mask & flags.CREATE:
+                # A created file is queued when it's closed, rather than while it's written
+                events.put(path)
+
+# Function to queue the directories whose modification time changed since the last scan. A
+# directory's time changes when files are added, removed or renamed in it, so unchanged
+# directories are never listed, only their remembered subdirectories are visited.
+def scan_directories(directory, known, events, initial=False):
+    try:
+        mtime = os.stat(directory).st_mtime_ns
+    except OSError:
+        return
+    entry = known.get(directory)
+    if entry is None or entry[0] != mtime:
+        try:
+            subdirs = scanner.scan(directory)[1]
+        except OSError as e:
+            print(e)
+            return
+        if not initial:
+            events.put(directory)
+        # Queue the subdirectories which disappeared so their files are dropped from the index
+        for subdir in (entry[1] if entry else []):
+            if subdir not in subdirs:
+                events.put(subdir)
+                for path in [path for path in known if path == subdir or path.startswith(subdir + os.sep)]:
+                    del known[path]
+        known[directory] = (mtime, subdirs)
+    for subdir in known[directory][1]:
+        scan_directories(subdir, known, events, initial)
+
+def watch_scan(directory, events, interval):
+    known = {}
+    scan_directories(directory, known, events, initial=True)
+    while True:
+        time.sleep(interval)
+        scan_directories(directory, known, events)
+
+# Function to bring the index in line with a batch of changed paths. Changed files are hashed
+# through the same pipeline as an update, a directory has its files checked against the index,
+# and a path which no longer exists is removed along with everything indexed below it.
+def apply_changes(paths, directory, jobs=1, threads=8):
+    if not os.path.isdir(directory):
+        print("├ Library unavailable: " + directory)
+        return
+    changed = []
+    removed = []
+    for path in paths:
+        if os.path.isdir(path):
+            prefix = os.path.join(path, "")
+            indexed = {}
+            for row in index.execute("SELECT path, size, mtime, inode FROM files WHERE substr(path, 1, ?) = ?", (len(prefix), prefix)):
+                if os.path.dirname(row['path']) == path:
+                    indexed[row['path']] = (row['size'], row['mtime'], row['inode'])
+            try:
+                entries = scanner.scan(path)[0]
+            except OSError as e:
+                print(e)
+                continue
+            names = set()
+            for entry in entries:
                 try:
-                    # Store file information in the local database
-                    index[file_uuid] = {
-                        'filename': filename,
-                        'extension': file_ext,
-                        'path': file_path,
-                        'hash': file_hash,
-                        'phash': file_phash
-                    }
-                except KeyError as e:
-                    print(e)
+                    stat = entry.stat()
+                except OSError:
+                    # Removed since the directory was listed
+                    continue
+                names.add(entry.path)
+                if indexed.get(entry.path) != (stat.st_size, stat.st_mtime_ns, stat.st_ino):
+                    changed.append((entry.path, stat))
+            removed.extend(file_path for file_path in indexed if file_path not in names)
+        elif os.path.isfile(path):
+            if not scanner.is_included(os.path.basename(path)):
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                removed.append(path)
+                continue
+            row = index.execute("SELECT size, mtime, inode FROM files WHERE path = ?", (path,)).fetchone()
+            if row is None or tuple(row) != (stat.st_size, stat.st_mtime_ns, stat.st_ino):
+                changed.append((path, stat))
+        else:
+            removed.append(path)
+    media = []
+    for record in index_files(changed, jobs):
+        store_record(index, record)
+        if has_metadata(record):
+            media.append(record['path'])
+    removed_count = 0
+    for path in removed:
+        prefix = os.path.join(path, "")
+        removed_count += index.execute("DELETE FROM files WHERE path = ? OR substr(path, 1, ?) = ?", (path, len(prefix), prefix)).rowcount
+    index.commit()
+    metadata_cache.extract(media, threads)
+    print("├ " + datetime.datetime.now().strftime('%H:%M:%S') + " Indexed: " + str(len(changed)) + " Removed: " + str(removed_count))
+
+# Function to keep the index updated as the library changes. A watcher thread queues changed
+# paths, with a bounded queue so a burst of changes holds the watcher back rather than memory,
+# and each path is indexed once it has been quiet for the debounce time.
+def watch_index(directory, jobs=1, threads=8, interval=60, metrics_path=None):
+    update_index(directory, jobs, threads)
+    events = queue.Queue(maxsize=watch_queue_size)
+    inotify = None
+    if INotify is not None and not is_network_mount(directory):
+        try:
+            inotify = INotify()
+        except OSError as e:
+            print(e)
+    if inotify is not None:
+        print("├ Watching " + directory + " with inotify")
+        watcher = threading.Thread(target=watch_inotify, args=(inotify, directory, events), daemon=True)
+    else:
+        print("├ Watching " + directory + " every " + str(interval) + " seconds")
+        watcher = threading.Thread(target=watch_scan, args=(directory, events, interval), daemon=True)
+    watcher.start()
+    pending = {}
+    try:
+        while True:
+            try:
+                path = events.get(timeout=debounce_time if pending else None)
+                pending[path] = time.monotonic()
+            except queue.Empty:
+                pass
+            # Index the quiet paths once the queue is drained, or in batches while it isn't
+            now = time.monotonic()
+            ready = [path for path, seen in pending.items() if now - seen >= debounce_time]
+            if ready and (events.empty() or len(ready) >= batch_size):
+                for path in ready:
+                    del pending[path]
+                apply_changes(ready, directory, jobs, threads)
+                if metrics_path:
+                    stages.write(metrics_path, "image-ai")
+    except KeyboardInterrupt:
+        print("├ Stopped Watching")
 
 def dedupe_index():
-    dd = {}
-    # Check for duplicate files by using the hash as the key
-    for key, value in index.items():
-        dd_key = value['hash']
-        dd_value = key
-        if dd_key in dd:
-            print("--")
-            print("A: " + str(index.get(dd[dd_key])['path']))
-            print("B: " + str(index.get(key)['path']))
-            print("--")
-            print("Enter A/B to delete or any other key to ignore")
-            user_input = input("> ")
-            if (user_input == "A" or user_input == "a"):
-                del index[dd[dd_key]]
-            elif (user_input == "B" or user_input == "b"):
-                del index[key]
-            else:
-                print("Ignoring")
+    # Only files sharing a size can be identical so hash just those
+    sizes = [row['size'] for row in index.execute("SELECT size FROM files WHERE size IS NOT NULL GROUP BY size HAVING COUNT(*) > 1")]
+    for size in sizes:
+        rows = index.execute("SELECT path, size, hash FROM files WHERE size = ? ORDER BY path", (size,)).fetchall()
+        for paths in find_duplicates([tuple(row) for row in rows]).values():
+            a_path = paths[0]
+            for b_path in paths[1:]:
+                print("--")
+                print("A: " + a_path)
+                print("B: " + b_path)
+                print("--")
+                print("Enter A/B to delete or any other key to ignore")
+                user_input = input("> ")
+                if (user_input == "A" or user_input == "a"):
+                    index.execute("DELETE FROM files WHERE path = ?", (a_path,))
+                    a_path = b_path
+                elif (user_input == "B" or user_input == "b"):
+                    index.execute("DELETE FROM files WHERE path = ?", (b_path,))
+                else:
+                    print("Ignoring")
+                index.commit()
+
+# Function to return the resolution of an image, 0 if it isn't known
+def get_resolution(file_path):
+    metadata = metadata_cache.get(file_path)
+    if metadata['width'] is None or metadata['height'] is None:
+        return 0
+    return metadata['width'] * metadata['height']
+
+# Function to return the sort key of a file for the dedupe policy, the file to keep sorts first
+def get_policy_key(file_path, policy, prefer):
+    key = []
+    for rule in policy:
+        if rule == 'preferred':
+            key.append(0 if prefer and file_path.startswith(os.path.join(prefer, "")) else 1)
+        elif rule == 'oldest':
+            key.append(get_date_taken(file_path, os.stat(file_path)))
+        elif rule == 'largest':
+            key.append(-get_resolution(file_path))
+        elif rule == 'shortest':
+            key.append(len(file_path))
         else:
-            dd[dd_key] = dd_value
+            raise ValueError("Unknown dedupe policy: " + rule)
+    key.append(file_path)
+    return key
 
-def hashmap_index():
-    # Create a map of file hashes
-    print("├ Total Index Count: " + str(len(index.keys())))
+# Function to return where a file is moved to in the trash directory, keeping its path
+# relative to the library so files with the same name don't collide
+def get_trash_path(file_path, trash):
+    if file_path.startswith(os.path.join(library, "")):
+        return os.path.join(trash, os.path.relpath(file_path, library))
+    return os.path.join(trash, file_path.lstrip(os.sep))
+
+# Function to dedupe the index without prompting. Every group of identical files is found in one
+# pass, the policy picks the file to keep and the others are moved to the trash directory, with
+# each move written to a journal which --undo reverses.
+def dedupe_index_batch(policy, prefer=None, trash=None, report_path=None, dry_run=False, threads=8):
+    if trash is None and not dry_run:
+        print("├ A trash directory is required to dedupe in batch mode")
+        return
+    groups = {}
+    sizes = [row['size'] for row in index.execute("SELECT size FROM files WHERE size IS NOT NULL GROUP BY size HAVING COUNT(*) > 1")]
+    for size in tqdm(sizes, ncols=100):
+        rows = index.execute("SELECT path, size, hash FROM files WHERE size = ?", (size,)).fetchall()
+        groups.update(find_duplicates([tuple(row) for row in rows]))
+    # Read the metadata the policy needs for every file up front
+    if 'oldest' in policy or 'largest' in policy:
+        metadata_cache.extract([file_path for paths in groups.values() for file_path in paths], threads)
+    # Plan every move before touching any files
+    moves = []
+    for file_hash, paths in groups.items():
+        paths = sorted(paths, key=lambda path: get_policy_key(path, policy, prefer))
+        for file_path in paths[1:]:
+            moves.append({
+                'hash': file_hash,
+                'keep': paths[0],
+                'source': file_path,
+                'destination': get_trash_path(file_path, trash) if trash else None
+            })
+    if report_path:
+        with open(report_path, "w") as report:
+            for move in moves:
+                report.write(json.dumps(move) + "\n")
+    print("├ Duplicate Files: " + str(len(moves)))
+    if dry_run:
+        for move in moves:
+            print("├ Keep " + move['keep'] + " Trash " + move['source'])
+        return
+    journal_path = os.path.join(os.path.expanduser("~"), "dedupe-" + datetime.datetime.now().strftime('%Y%m%d_%H%M%S') + ".jsonl")
+    with Journal(journal_path) as journal:
+        for move in moves:
+            # Journal each move before it's made so it can be undone even if the run is interrupted
+            journal.write(move)
+            try:
+                os.makedirs(os.path.dirname(move['destination']), exist_ok=True)
+                shutil.move(move['source'], move['destination'])
+            except OSError as e:
+                print(e)
+                continue
+            index.execute("DELETE FROM files WHERE path = ?", (move['source'],))
+    index.commit()
+    print("├ Undo Journal: " + journal_path)
+
+# Function to move the files in a dedupe journal back from the trash directory and re-index them
+def undo_dedupe(journal_path):
+    restored_count = 0
+    for move in undo_moves(journal_path):
+        store_record(index, index_file(move['source'], os.stat(move['source'])))
+        restored_count += 1
+    index.commit()
+    print("├ Restored: " + str(restored_count))
+
+def hashmap_index(threshold):
+    # Count the file hashes and perceptual hashes which occur more than once
+    print("├ Total Index Count: " + str(index.execute("SELECT COUNT(*) FROM files").fetchone()[0]))
     if debug == True:
         print("└─ // DEBUG")
-        print(next(iter(index.items())))
+        print(tuple(index.execute("SELECT * FROM files LIMIT 1").fetchone() or ()))
         print("┌─")
-    hashmap.clear()
-    dupe_count = 0
-    for key, value in index.items():
-        hashmap_key = value['hash']
-        hashmap_value = key
-        if hashmap_key in hashmap:
-            dupe_count += 1
-        else:
-            hashmap[hashmap_key] = hashmap_value
+    dupe_count = index.execute("SELECT COUNT(hash) - COUNT(DISTINCT hash) FROM files").fetchone()[0]
+    print("├ Duplicate Index File Hashes: " + str(dupe_count))
+    dupe_count = index.execute("""
+        SELECT COUNT(phash) - COUNT(DISTINCT phash) FROM (
+            SELECT phash0 AS phash FROM files UNION ALL
+            SELECT phash1 FROM files UNION ALL
+            SELECT phash2 FROM files UNION ALL
+            SELECT phash3 FROM files
+        )""").fetchone()[0]
+    print("├ Duplicate Perceptual Hashes: " + str(dupe_count))
+    # Pair each image with the library images within the threshold of its perceptual hash
+    tree = build_phash_tree()
+    near_pairs = set()
+    for row in index.execute("SELECT path, phash0 FROM files WHERE phash0 IS NOT NULL"):
+        for file_path in find_near_duplicates(tree, to_unsigned(row['phash0']), threshold):
+            if file_path != row['path']:
+                near_pairs.add(tuple(sorted((row['path'], file_path))))
     if debug == True:
         print("└─ // DEBUG")
-        print(next(iter(hashmap.items())))
+        print(next(iter(near_pairs), None))
         print("┌─")
-    print("├ Duplicate Index File Hashes: " + str(dupe_count))
-    # Create a map of perceptual hashes
-    hashmap.clear()
-    dupe_count = 0
-    for key, value in index.items():
-        if not value['phash'] == None:
-            for phash_key, phash_value in value['phash'].items():
-                hashmap_key = str(phash_value)
-                hashmap_value = str(key)
-                if hashmap_key in hashmap:
-                    dupe_count += 1
-                else:
-                    hashmap[hashmap_key] = hashmap_value
-
+    print("├ Near Duplicate Image Pairs (threshold " + str(threshold) + "): " + str(len(near_pairs)))
+    video_pairs = find_near_duplicate_videos(threshold)
     if debug == True:
         print("└─ // DEBUG")
-        print(next(iter(hashmap.items())))
+        print(next(iter(video_pairs.items()), None))
         print("┌─")
-    print("├ Duplicate Perceptual Hashes: " + str(dupe_count))
+    print("├ Near Duplicate Video Pairs (threshold " + str(threshold) + "): " + str(len(video_pairs)))
 
 
-def dedupe_source(directory):
-    file_count = sum(len([f for f in files if not f[0] == '.']) for _, _, files in os.walk(directory))
-    for root, _, files in os.walk(directory):
-        files = [f for f in files if not f[0] == '.']
-        for filename in files:
-            file_path = os.path.join(root, filename)
-            file_hash = compute_hash(file_path)
-            print(file_hash)
+# Function to return the date an image was taken from its EXIF metadata, falling back to
+# the modification time of the file
+def get_date_taken(file_path, stat):
+    try:
+        return datetime.datetime.strptime(metadata_cache.get(file_path)['date_taken'], '%Y:%m:%d %H:%M:%S')
+    except (TypeError, ValueError):
+        return datetime.datetime.fromtimestamp(stat.st_mtime)
+
+# Function to return a path in the library's YYYY/MM folders which isn't already taken
+def get_library_path(file_path, stat):
+    date = get_date_taken(file_path, stat)
+    folder = os.path.join(library, date.strftime('%Y'), date.strftime('%m'))
+    name, extension = os.path.splitext(os.path.basename(file_path))
+    library_path = os.path.join(folder, name + extension)
+    suffix = 0
+    while os.path.exists(library_path):
+        suffix += 1
+        library_path = os.path.join(folder, name + "-" + str(suffix) + extension)
+    return library_path
 
-def detect_trash():
-    item_count = len(index.items())
-    with tqdm(total=item_count, ncols=100) as pbar:
-        for key, value in index.items():
+# Function to classify a source file against the library index as a duplicate, near
+# duplicate or new file, returning the status, the matching library path and the distance
+def classify_source_file(file_path, stat, tree, threshold):
+    # The source is hashed once and an identical copy is looked up by the indexed hash
+    file_hash = compute_hash(file_path)
+    if file_hash is None:
+        return 'skipped', None, None, None
+    row = index.execute("SELECT path FROM files WHERE size = ? AND hash = ? LIMIT 1", (stat.st_size, file_hash)).fetchone()
+    if row is not None:
+        return 'duplicate', row['path'], 0, None
+    # Only library files of the same size which were never hashed are read to look for a copy
+    rows = index.execute("SELECT path, size, hash FROM files WHERE size = ? AND hash IS NULL", (stat.st_size,)).fetchall()
+    if rows:
+        for paths in find_duplicates([(file_path, stat.st_size, file_hash)] + [tuple(row) for row in rows]).values():
+            if file_path in paths:
+                return 'duplicate', next(path for path in paths if path != file_path), 0, None
+    record = index_file(file_path, stat, file_hash)
+    if tree is not None and record['phash'] is not None:
+        matches = find_near_duplicates(tree, record['phash'][0], threshold)
+        if matches:
+            match_path = min(matches, key=matches.get)
+            return 'near-duplicate', match_path, matches[match_path], record
+    return 'new', None, None, record
+
+# Function to stream a source directory into the library. Each file is checked against the
+# index as it is found, so memory use doesn't grow with the size of the source, and new files
+# are moved into the library by date and added to the index. Only images and videos are imported,
+# other files such as sidecars are left in the source and reported as skipped.
+def import_source(directory, threshold, report_path=None, dry_run=False):
+    # Build the perceptual hash tree once the first image needs it
+    tree = None
+    counts = {'duplicate': 0, 'near-duplicate': 0, 'new': 0, 'skipped': 0}
+    report = open(report_path, "w") if report_path else None
+    try:
+        with tqdm(total=0, ncols=100, unit=" files") as pbar:
+            for file_path, stat in walk_files(directory, pbar):
+                pbar.update(1)
+                image = is_image(file_path)
+                if tree is None and image:
+                    tree = build_phash_tree()
+                if image or is_video(file_path):
+                    status, match_path, distance, record = classify_source_file(file_path, stat, tree, threshold)
+                else:
+                    status, match_path, distance, record = 'skipped', None, None, None
+                counts[status] += 1
+                library_path = None
+                if status == 'new':
+                    library_path = get_library_path(file_path, stat)
+                    if not dry_run:
+                        os.makedirs(os.path.dirname(library_path), exist_ok=True)
+                        shutil.move(file_path, library_path)
+                        library_stat = os.stat(library_path)
+                        record.update({
+                            'filename': os.path.basename(library_path),
+                            'path': library_path,
+                            'size': library_stat.st_size,
+                            'mtime': library_stat.st_mtime_ns,
+                            'inode': library_stat.st_ino
+                        })
+                        store_record(index, record)
+                        index.commit()
+                        # Later source files are checked against the files imported before them
+                        if tree is not None and record['phash'] is not None:
+                            for rotation in range(4):
+                                tree.add(record['phash'][rotation], library_path)
+                if report is not None:
+                    report.write(json.dumps({
+                        'source': file_path,
+                        'status': status,
+                        'match': match_path,
+                        'distance': distance,
+                        'destination': library_path
+                    }) + "\n")
+    finally:
+        if report is not None:
+            report.close()
+    print("├ Duplicates: " + str(counts['duplicate']) + " Near Duplicates: " + str(counts['near-duplicate']) + " New: " + str(counts['new']) + " Skipped: " + str(counts['skipped']))
+
+def detect_trash(threads=8):
+    paths = [row['path'] for row in index.execute("SELECT path FROM files")]
+    metadata_cache.extract(paths, threads)
+    with tqdm(total=len(paths), ncols=100) as pbar:
+        for file_path in paths:
             pbar.update(1)
-            #print(value['path'])
-            if not is_camera(value['path']):
-                src = value['path']
+            #print(file_path)
+            if not is_camera(file_path):
+                src = file_path
                 dst = args.trash
                 shutil.move(src, dst)
 
@@ -206,25 +1002,55 @@ def main():
     # Directory to move files from
     source = args.source
     if args.rebuild:
-        rebuild_index(directory)
+        rebuild_index(directory, args.jobs, args.threads, args.resume)
+        print("")
+    elif args.update:
+        update_index(directory, args.jobs, args.threads)
         print("")
     else:
         print("├ Rebuild Index? No")
-    if args.dedupe:
+    if args.undo:
+        undo_dedupe(args.undo)
+    if args.dedupe and args.batch:
+        dedupe_index_batch(args.policy.split(","), args.prefer, args.trash, args.report, args.dry_run, args.threads)
+    elif args.dedupe:
         dedupe_index()
     else:
         print("├ Detect Duplicates? No")
+    if args.hashmap:
+        hashmap_index(args.threshold)
     if args.source:
-        hashmap_index()
-        dedupe_source(source)
+        import_source(source, args.threshold, args.report, args.dry_run)
     else:
         print("├ Import Source? No")
+    if args.watch:
+        watch_index(directory, args.jobs, args.threads, args.interval, args.metrics)
     # if args.trash:
-    #     detect_trash()
+    #     detect_trash(args.threads)
     # else:
     #     print("Detect Trash? No")
 
 if __name__ == '__main__':
-    main()
+    args = parser.parse_args()
+    # Check the policy before any work starts rather than part way through a dedupe
+    unknown_rules = [rule for rule in args.policy.split(",") if rule not in policy_rules]
+    if unknown_rules:
+        parser.error("unknown dedupe policy rule: " + ", ".join(unknown_rules))
+    # Indexed paths are absolute, so a relative preferred directory would never match them
+    if args.prefer:
+        args.prefer = os.path.abspath(args.prefer)
+    chunk_size = args.chunk_size
+    extensions = [extension.strip().lower() for extension in args.extensions.split(",")] if args.extensions else None
+    scanner = Scanner([name for name in args.ignore.split(",") if name], extensions, args.include_hidden)
+    # Open the database here so worker processes importing this module don't open it
+    index = open_index(index_db)
+    metadata_cache = MetadataCache(index)
+    thumbnail_cache = ThumbnailCache(index, thumbnail_db, args.cache_size * 1024 * 1024)
+    with profile(args.profile, os.path.join(os.path.expanduser("~"), "profile-" + datetime.datetime.now().strftime('%Y%m%d_%H%M%S'))):
+        main()
+    if args.metrics:
+        stages.write(args.metrics, "image-ai")
+    metadata_cache.close()
+    thumbnail_cache.flush()
+    index.commit()
     index.close()
-    hashmap.close()
@@ -0,0 +1,55 @@
+import json
+import os
+import shutil
+import threading
+
+# Write-ahead journal of file moves in JSON lines, shared by the dedupe in image-ai.py and the
+# renames in rename.py. Each move is written and synced before the file is moved, so after a
+# crash the journal holds every move which may have happened, and whether it did is read from
+# the filesystem rather than trusted to the journal.
+class Journal:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, "a")
+
+    # Function to record a move, which needs a source and a destination, before it's made
+    def write(self, entry):
+        with self.lock:
+            self.file.write(json.dumps(entry) + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def read_journal(path):
+    with open(path) as journal:
+        return [json.loads(line) for line in journal if line.strip()]
+
+# Function to check if a journalled move was carried out
+def is_moved(entry):
+    return os.path.exists(entry['destination']) and not os.path.exists(entry['source'])
+
+# Function to reverse the moves of a journal newest first, yielding each move which was
+# restored. Moves which never happened or were already undone are skipped.
+def undo_moves(path):
+    for entry in reversed(read_journal(path)):
+        if not os.path.exists(entry['destination']):
+            continue
+        if os.path.exists(entry['source']):
+            print("├ Not restoring over existing file " + entry['source'])
+            continue
+        try:
+            os.makedirs(os.path.dirname(entry['source']), exist_ok=True)
+            shutil.move(entry['destination'], entry['source'])
+        except OSError as e:
+            print(e)
+            continue
+        yield entry
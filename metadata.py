@@ -0,0 +1,311 @@
+import json
+import os
+import piexif
+import shutil
+import struct
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from metrics import stages
+
+# The columns cached for each file, the size and modification time tell when the file changed
+fields = ('path', 'size', 'mtime', 'make', 'model', 'date_taken', 'orientation', 'width', 'height')
+
+# Videos have their metadata read by exiftool
+video_extensions = ('.mp4', '.mov', '.m4v')
+# The number of videos passed to exiftool in each command
+video_batch_size = 100
+
+# Function to check if file has a video extension
+def is_video(filename):
+    return filename.lower().endswith(video_extensions)
+
+# A long running exiftool process which is sent commands through its argument file on stdin,
+# avoiding the Perl start up time of a new process for every file https://exiftool.org/#performance
+class ExifTool:
+    def __init__(self, executable="exiftool"):
+        self.process = subprocess.Popen(
+            [executable, "-stay_open", "True", "-@", "-"],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+
+    # Function to run one command and return its output, which ends at the {ready} line
+    def execute(self, *args):
+        self.process.stdin.write("\n".join(args) + "\n-execute\n")
+        self.process.stdin.flush()
+        output = []
+        while True:
+            line = self.process.stdout.readline()
+            if not line:
+                raise OSError("exiftool exited unexpectedly")
+            if line.strip() == "{ready}":
+                return "".join(output)
+            output.append(line)
+
+    # Function to return the tags of a batch of files as a list of dictionaries
+    def get_tags(self, paths, tags):
+        output = self.execute("-json", "-n", *("-" + tag for tag in tags), *paths)
+        return json.loads(output) if output.strip() else []
+
+    def close(self):
+        if self.process.poll() is None:
+            try:
+                self.process.stdin.write("-stay_open\nFalse\n")
+                self.process.stdin.flush()
+            except BrokenPipeError:
+                # Exited since the poll
+                pass
+            self.process.wait()
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.process.stdout.close()
+
+# Function to read the EXIF (APP1) segment and the frame dimensions of a JPEG, stopping at the
+# start of the compressed image data so the rest of the file is never read. A truncated header
+# returns what was read before it.
+def read_exif_header(file_path):
+    exif = None
+    width = None
+    height = None
+    with open(file_path, "rb") as f:
+        if f.read(2) != b"\xff\xd8":
+            return None, None, None
+        while True:
+            marker = f.read(2)
+            if len(marker) < 2 or marker[0] != 0xFF:
+                break
+            code = marker[1]
+            # Skip fill bytes and markers which have no length
+            if code == 0xFF:
+                f.seek(-1, 1)
+                continue
+            if code == 0x01 or 0xD0 <= code <= 0xD7:
+                continue
+            # Start of scan or end of image
+            if code in (0xDA, 0xD9):
+                break
+            length = f.read(2)
+            if len(length) < 2:
+                break
+            data = f.read(struct.unpack(">H", length)[0] - 2)
+            if code == 0xE1 and exif is None and data.startswith(b"Exif\x00\x00"):
+                exif = data
+            elif 0xC0 <= code <= 0xCF and code not in (0xC4, 0xC8, 0xCC):
+                # Start of frame, the metadata segments all come before it
+                if len(data) >= 5:
+                    height, width = struct.unpack(">HH", data[1:5])
+                break
+    return exif, width, height
+
+# Function to replace the EXIF (APP1) segment of a JPEG without decoding the image. The segments
+# before the image data are rewritten and the rest is copied byte for byte into a temporary file,
+# which then replaces the original so an interrupted write never leaves a truncated photo.
+def write_exif_header(file_path, exif_bytes):
+    if len(exif_bytes) > 65533:
+        raise ValueError("EXIF data is too large for a JPEG segment")
+    segment = b"\xff\xe1" + struct.pack(">H", len(exif_bytes) + 2) + exif_bytes
+    temp_path = file_path + ".exif"
+    try:
+        with open(file_path, "rb") as src, open(temp_path, "wb") as dst:
+            if src.read(2) != b"\xff\xd8":
+                raise ValueError("Not a JPEG file: " + file_path)
+            dst.write(b"\xff\xd8")
+            written = False
+            while True:
+                marker = src.read(2)
+                if len(marker) < 2 or marker[0] != 0xFF:
+                    raise ValueError("Corrupt JPEG segment in " + file_path)
+                code = marker[1]
+                if code == 0xFF:
+                    src.seek(-1, 1)
+                    continue
+                # Keep a JFIF (APP0) segment first, the EXIF segment goes before anything else
+                if code != 0xE0 and not written:
+                    dst.write(segment)
+                    written = True
+                # Copy the start of scan and the compressed image data after it unchanged
+                if code == 0xDA:
+                    dst.write(marker)
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+                    break
+                length = src.read(2)
+                if len(length) < 2:
+                    raise ValueError("Truncated JPEG header in " + file_path)
+                data = src.read(struct.unpack(">H", length)[0] - 2)
+                # Drop the old EXIF segment
+                if code == 0xE1 and data.startswith(b"Exif\x00\x00"):
+                    continue
+                dst.write(marker + length + data)
+        shutil.copymode(file_path, temp_path)
+        os.replace(temp_path, file_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+# Function to decode an EXIF string value
+def decode_value(value):
+    if value is None:
+        return None
+    return value.decode("utf-8", errors="replace").strip("\x00 ").strip() or None
+
+# Function to return empty metadata for a file, recording the size and time it was read at
+def new_metadata(file_path, stat=None):
+    if stat is None:
+        stat = os.stat(file_path)
+    metadata = dict.fromkeys(fields)
+    metadata.update({'path': file_path, 'size': stat.st_size, 'mtime': stat.st_mtime_ns})
+    return metadata
+
+# Function to extract the metadata of a file from its EXIF header, None if the file is gone
+@stages.timed('exif')
+def read_metadata(file_path, stat=None):
+    try:
+        metadata = new_metadata(file_path, stat)
+    except OSError as e:
+        print(e)
+        return None
+    try:
+        exif, width, height = read_exif_header(file_path)
+        metadata['width'] = width
+        metadata['height'] = height
+        if exif is None:
+            return metadata
+        exif_dict = piexif.load(exif)
+    except Exception as e:
+        print(f"Error loading EXIF data: {e}")
+        return metadata
+    metadata['make'] = decode_value(exif_dict['0th'].get(piexif.ImageIFD.Make))
+    metadata['model'] = decode_value(exif_dict['0th'].get(piexif.ImageIFD.Model))
+    metadata['orientation'] = exif_dict['0th'].get(piexif.ImageIFD.Orientation)
+    # Fall back to the modification date when the original date is missing or blank
+    metadata['date_taken'] = decode_value(exif_dict['Exif'].get(piexif.ExifIFD.DateTimeOriginal)) or decode_value(exif_dict['0th'].get(piexif.ImageIFD.DateTime))
+    if metadata['width'] is None:
+        metadata['width'] = exif_dict['Exif'].get(piexif.ExifIFD.PixelXDimension)
+        metadata['height'] = exif_dict['Exif'].get(piexif.ExifIFD.PixelYDimension)
+    return metadata
+
+# Function to convert the exiftool tags of a video to metadata
+def video_metadata(tags):
+    metadata = new_metadata(tags['SourceFile'])
+    metadata['make'] = str(tags['Make']) if 'Make' in tags else None
+    metadata['model'] = str(tags['Model']) if 'Model' in tags else None
+    metadata['width'] = tags.get('ImageWidth')
+    metadata['height'] = tags.get('ImageHeight')
+    # Videos without a recorded date report zeros
+    if str(tags.get('CreateDate', '')).strip('0: '):
+        metadata['date_taken'] = str(tags['CreateDate'])
+    return metadata
+
+# Cache of file metadata stored in the index database, shared by image-ai.py and rename.py
+class MetadataCache:
+    def __init__(self, db, executable="exiftool"):
+        self.db = db
+        # The exiftool process is only started once a video needs it
+        self.executable = executable
+        self.exiftool = None
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS metadata (
+                path TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime INTEGER,
+                make TEXT,
+                model TEXT,
+                date_taken TEXT,
+                orientation INTEGER,
+                width INTEGER,
+                height INTEGER
+            )""")
+        self.db.commit()
+
+    # Function to return the cached metadata of a file, None if it's missing or the file changed
+    def lookup(self, file_path):
+        row = self.db.execute("SELECT * FROM metadata WHERE path = ?", (file_path,)).fetchone()
+        if row is None:
+            return None
+        metadata = dict(zip(fields, tuple(row)))
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return None
+        if (metadata['size'], metadata['mtime']) != (stat.st_size, stat.st_mtime_ns):
+            return None
+        return metadata
+
+    def store(self, metadata):
+        self.db.execute("INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", tuple(metadata[field] for field in fields))
+
+    # Function to return the metadata of a file, reading it when it isn't cached
+    def get(self, file_path):
+        metadata = self.lookup(file_path)
+        if metadata is None:
+            if is_video(file_path):
+                self.extract_videos([file_path])
+                return self.lookup(file_path) or new_metadata(file_path)
+            metadata = read_metadata(file_path)
+            if metadata is None:
+                return dict.fromkeys(fields)
+            self.store(metadata)
+            self.db.commit()
+        return metadata
+
+    # Function to read the metadata of many files, images across a thread pool since the time
+    # goes on network latency rather than parsing, and videos in batches through exiftool. The
+    # cache is read in one query and each file is checked against it with a stat in the pool.
+    # Results are written from the calling thread.
+    def extract(self, paths, threads=8):
+        cached = {row[0]: (row[1], row[2]) for row in self.db.execute("SELECT path, size, mtime FROM metadata")}
+        # Function to return the stat of a file whose cached metadata is missing or stale, None
+        # if the cache is current or the file is gone
+        def stale_stat(file_path):
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                return None
+            return None if cached.get(file_path) == (stat.st_size, stat.st_mtime_ns) else stat
+        def read_stale(file_path):
+            stat = stale_stat(file_path)
+            return None if stat is None else read_metadata(file_path, stat)
+        videos = [file_path for file_path in paths if is_video(file_path)]
+        images = [file_path for file_path in paths if not is_video(file_path)]
+        extracted_count = 0
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            for metadata in executor.map(read_stale, images):
+                if metadata is not None:
+                    self.store(metadata)
+                    extracted_count += 1
+            videos = [file_path for file_path, stat in zip(videos, executor.map(stale_stat, videos)) if stat is not None]
+        self.db.commit()
+        self.extract_videos(videos)
+        return extracted_count + len(videos)
+
+    # Function to read the metadata of videos through one exiftool process
+    def extract_videos(self, paths):
+        if not paths:
+            return
+        try:
+            if self.exiftool is None:
+                self.exiftool = ExifTool(self.executable)
+            for i in range(0, len(paths), video_batch_size):
+                with stages.time('exiftool'):
+                    batch = self.exiftool.get_tags(paths[i:i + video_batch_size], ('CreateDate', 'Make', 'Model', 'ImageWidth', 'ImageHeight'))
+                for tags in batch:
+                    try:
+                        self.store(video_metadata(tags))
+                    except OSError as e:
+                        # The video was removed since exiftool read it
+                        print(e)
+        except (OSError, ValueError) as e:
+            print(f"Error loading video metadata: {e}")
+            # Start a new exiftool process for the next batch, this one may have exited
+            self.close()
+        self.db.commit()
+
+    def close(self):
+        if self.exiftool is not None:
+            self.exiftool.close()
+            self.exiftool = None
+
+    # Function to check if an image was taken with a camera
+    def is_camera(self, file_path):
+        metadata = self.get(file_path)
+        return metadata['make'] is not None and metadata['model'] is not None
@@ -0,0 +1,154 @@
+import bisect
+import contextlib
+import cProfile
+import datetime
+import functools
+import json
+import threading
+import time
+import tracemalloc
+
+# The upper bounds in seconds of the latency histogram buckets of each stage
+buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, float('inf'))
+
+# Function to return an empty stage
+def new_stage():
+    return {'count': 0, 'seconds': 0.0, 'bytes': 0, 'buckets': [0] * len(buckets)}
+
+# Time, bytes and latency histogram of each stage of a run, with plain counters beside them.
+# Stages are recorded from the threads of a pool too, and a worker process sends what it
+# recorded back to the main process to merge.
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.stages = {}
+        self.counters = {}
+
+    def record(self, stage, seconds, nbytes=0):
+        with self.lock:
+            totals = self.stages.setdefault(stage, new_stage())
+            totals['count'] += 1
+            totals['seconds'] += seconds
+            totals['bytes'] += nbytes
+            totals['buckets'][bisect.bisect_left(buckets, seconds)] += 1
+
+    # Function to time the code run inside a with block as one item of a stage
+    @contextlib.contextmanager
+    def time(self, stage, nbytes=0):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start, nbytes)
+
+    # Function to return a decorator which times every call of a function as one item of a stage
+    def timed(self, stage):
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.time(stage):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def increment(self, counter, value=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    # Function to return what was recorded, optionally starting again from nothing
+    def collect(self, reset=False):
+        with self.lock:
+            collected = {'stages': self.stages, 'counters': self.counters}
+            if reset:
+                self.stages = {}
+                self.counters = {}
+            else:
+                collected = json.loads(json.dumps(collected))
+        return collected
+
+    # Function to add what another process recorded
+    def merge(self, collected):
+        with self.lock:
+            for stage, other in collected['stages'].items():
+                totals = self.stages.setdefault(stage, new_stage())
+                totals['count'] += other['count']
+                totals['seconds'] += other['seconds']
+                totals['bytes'] += other['bytes']
+                totals['buckets'] = [a + b for a, b in zip(totals['buckets'], other['buckets'])]
+            for counter, value in collected['counters'].items():
+                self.counters[counter] = self.counters.get(counter, 0) + value
+
+    # Function to write the metrics to a Prometheus text file when the path ends in .prom,
+    # otherwise to append them to a JSON lines file with one line for each stage and counter
+    def write(self, path, script):
+        collected = self.collect()
+        if path.endswith(".prom"):
+            with open(path, "w") as f:
+                f.write(self.prometheus(collected, script))
+            return
+        timestamp = datetime.datetime.now().isoformat()
+        elapsed = time.time() - self.started
+        with open(path, "a") as f:
+            for stage, totals in sorted(collected['stages'].items()):
+                f.write(json.dumps({
+                    'timestamp': timestamp,
+                    'script': script,
+                    'stage': stage,
+                    'count': totals['count'],
+                    'seconds': totals['seconds'],
+                    'bytes': totals['bytes'],
+                    # Throughput over the time spent in the stage, and over the whole run
+                    'items_per_second': totals['count'] / totals['seconds'] if totals['seconds'] else None,
+                    'bytes_per_second': totals['bytes'] / totals['seconds'] if totals['seconds'] else None,
+                    'run_items_per_second': totals['count'] / elapsed if elapsed else None,
+                    'buckets': dict(zip((str(bound) for bound in buckets), totals['buckets']))
+                }) + "\n")
+            for counter, value in sorted(collected['counters'].items()):
+                f.write(json.dumps({'timestamp': timestamp, 'script': script, 'counter': counter, 'value': value}) + "\n")
+
+    def prometheus(self, collected, script):
+        lines = [
+            "# HELP imageai_stage_seconds Time spent in each stage of a run",
+            "# TYPE imageai_stage_seconds histogram"
+        ]
+        for stage, totals in sorted(collected['stages'].items()):
+            labels = f'script="{script}",stage="{stage}"'
+            cumulative = 0
+            for bound, count in zip(buckets, totals['buckets']):
+                cumulative += count
+                lines.append(f'imageai_stage_seconds_bucket{{{labels},le="{"+Inf" if bound == float("inf") else bound}"}} {cumulative}')
+            lines.append(f"imageai_stage_seconds_sum{{{labels}}} {totals['seconds']}")
+            lines.append(f"imageai_stage_seconds_count{{{labels}}} {totals['count']}")
+        lines.append("# HELP imageai_stage_bytes_total Bytes processed by each stage of a run")
+        lines.append("# TYPE imageai_stage_bytes_total counter")
+        for stage, totals in sorted(collected['stages'].items()):
+            lines.append(f'imageai_stage_bytes_total{{script="{script}",stage="{stage}"}} {totals["bytes"]}')
+        lines.append("# HELP imageai_events_total Events counted during a run")
+        lines.append("# TYPE imageai_events_total counter")
+        for counter, value in sorted(collected['counters'].items()):
+            lines.append(f'imageai_events_total{{script="{script}",event="{counter}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+# The metrics of this process, shared by every module
+stages = Metrics()
+
+# Function to run the code inside a with block under cProfile and tracemalloc when enabled,
+# writing the profile to <prefix>.prof for pstats or snakeviz and the allocations still held at
+# the end to <prefix>.tracemalloc for tracemalloc.Snapshot.load
+@contextlib.contextmanager
+def profile(enabled, prefix):
+    if not enabled:
+        yield
+        return
+    profiler = cProfile.Profile()
+    tracemalloc.start()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(prefix + ".prof")
+        tracemalloc.take_snapshot().dump(prefix + ".tracemalloc")
+        tracemalloc.stop()
+        print("Profile: " + prefix + ".prof " + prefix + ".tracemalloc")
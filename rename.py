@@ -1,45 +1,69 @@
 import os
 import datetime
-from PIL import Image
 import argparse
+import functools
 # import filecmp
 import hashlib
 import piexif
-# import shutil
-import subprocess
+import shutil
+import sqlite3
+import time
 from skimage.metrics import structural_similarity as ssim
 import cv2
+import metadata
+import thumbcache
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from journal import Journal, is_moved, read_journal, undo_moves
+from metadata import MetadataCache, read_exif_header, write_exif_header
+from metrics import profile, stages
+from scanner import Scanner, ignored_names
+from thumbcache import ThumbnailCache
 
 # Set up command line argument parser
 parser = argparse.ArgumentParser()
-parser.add_argument("directory", help="the directory containing the photos")
+parser.add_argument("directory", nargs="?", help="the directory containing the photos")
 parser.add_argument("--suffix", help="an optional suffix to append to the new filename")
 parser.add_argument("--dedupe", action='store_true', help="an optional directory to dedupe photos")
 parser.add_argument("--compare", action='store_true', help="an optional suffix to compare files")
 parser.add_argument("--target", help="an optional suffix for the target directoy")
 parser.add_argument("--trash", help="an optional suffix for the trash directoy")
+parser.add_argument("--chunk-size", type=int, default=1024 * 1024, help="the number of bytes read at a time when hashing files")
+parser.add_argument("--threads", type=int, default=8, help="the number of threads used to read EXIF metadata and move files")
+parser.add_argument("--cache-size", type=int, default=1024, help="the size cap of the thumbnail cache in MB")
+parser.add_argument("--ignore", default=",".join(ignored_names), help="a comma separated list of file and directory names to skip, besides hidden files")
+parser.add_argument("--metrics", help="an optional file to write per stage metrics to, Prometheus text if it ends in .prom and JSON lines otherwise")
+parser.add_argument("--profile", action='store_true', help="capture a cProfile profile and tracemalloc snapshot of the run in the home directory")
+parser.add_argument("--ssim-threshold", type=float, default=1.0, help="the structural similarity of the downscaled images at which they are treated as identical")
+parser.add_argument("--resume", help="the journal of an interrupted run, whose moves are skipped and which this run's moves are appended to")
+parser.add_argument("--undo", help="a rename journal whose moves are reversed")
 args = parser.parse_args()
+if args.directory is None and args.undo is None:
+    parser.error("the directory is required")
 
+# The EXIF metadata and thumbnail caches are shared with image-ai.py through its index database
+index_db = os.path.join(os.path.expanduser("~"), 'index.sqlite')
+thumbnail_db = os.path.join(os.path.expanduser("~"), 'thumbnails.bin')
+index = sqlite3.connect(index_db)
+metadata_cache = MetadataCache(index)
+thumbnail_cache = ThumbnailCache(index, thumbnail_db, args.cache_size * 1024 * 1024)
 
-# Function to check if file has image extension
+
+# Function to check if file is an image, from its magic bytes rather than its extension
 def is_image(filename):
-    return filename.lower().endswith((".jpg", ".jpeg"))
+    return thumbcache.is_image(filename)
+
+# Function to check if file is a JPEG, the only format whose EXIF header is read and rewritten
+# when renaming
+def is_jpeg(filename):
+    return thumbcache.sniff_format(filename) == 'jpeg'
 
-# Function to check if file has image extension
+# Function to check if file has video extension
 def is_video(filename):
-    return filename.lower().endswith(".mp4")
+    return metadata.is_video(filename)
 
 # function to check if an image was taken with a camera
 def is_camera(filename):
-    try:
-        exif_dict = piexif.load(filename)
-        if piexif.ImageIFD.Make in exif_dict['0th'] and piexif.ImageIFD.Model in exif_dict['0th']:
-            return True
-        else:
-            return False
-    except Exception as e:
-        print(f"Error loading EXIF data: {e}")
-        return False
+    return metadata_cache.is_camera(os.path.abspath(filename))
 
 # Function to check and fix exif tags
 def check_exif(exif_dict):
@@ -51,9 +75,15 @@ def check_exif(exif_dict):
             print(f"\033[33m\u25E6 INFO: {e}. Missing exif_dict tag\033[0m")
     return exif_dict
 
-def get_mp4_creation_time(filename):
-    output = subprocess.check_output(['exiftool', '-CreateDate', '-b', filename])
-    return output.decode('utf-8').strip()
+# Function to return the creation time of a video, read through the shared exiftool process
+def get_video_creation_time(filename):
+    return metadata_cache.get(os.path.abspath(filename))['date_taken']
+
+# function to check if two files are identical, only hashing them when their sizes match
+def is_identical(filename, other):
+    if os.path.getsize(filename) != os.path.getsize(other):
+        return False
+    return get_hash(filename) == get_hash(other)
 
 # function to return the sha256 hash for a given file
 def hash_file(filename):
@@ -63,47 +93,318 @@ def hash_file(filename):
         hasher = hashlib.sha256()
         # Loop over the file, feeding it into the hash object in chunks
         while True:
-            chunk = f.read(4096)
+            start = time.perf_counter()
+            chunk = f.read(args.chunk_size)
+            stages.record('read', time.perf_counter() - start, len(chunk))
             if not chunk:
                 break
-            hasher.update(chunk)
+            with stages.time('sha256', len(chunk)):
+                hasher.update(chunk)
         # Return the hexadecimal representation of the hash
         return hasher.hexdigest()
 
+# Function to return the hash of a file without reading it again. A hash image-ai.py recorded
+# in the index is used while the size and modification time still match, and hashes computed
+# here are kept by path, size and modification time, so comparing many files with one target
+# reads the target once.
+def get_hash(filename):
+    stat = os.stat(filename)
+    return cached_hash(os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+
+@functools.lru_cache(maxsize=4096)
+def cached_hash(file_path, size, mtime):
+    try:
+        row = index.execute("SELECT hash FROM files WHERE path = ? AND size = ? AND mtime = ?", (file_path, size, mtime)).fetchone()
+    except sqlite3.OperationalError:
+        # The index hasn't been built by image-ai.py
+        row = None
+    if row is not None and row[0]:
+        return row[0]
+    return hash_file(file_path)
+
+# Function to return the cached features of an image, decoding it only the first time its
+# content is seen
+def get_features(filename, file_hash=None):
+    return thumbnail_cache.get(os.path.abspath(filename), file_hash or get_hash(filename))
+
 # function to return the perceptual hash for an image https://www.hackerfactor.com/blog/?/archives/432-Looks-Like-It.html
-def perceptual_hash(filename):
+def perceptual_hash(filename, file_hash=None):
     try:
-        imread = cv2.cvtColor(cv2.imread(filename), cv2.IMREAD_IGNORE_ORIENTATION, cv2.COLOR_BGR2GRAY)
-        imhash = cv2.img_hash.pHash(imread) # 8-byte hash
-        perceptual_hash = int.from_bytes(imhash.tobytes(), byteorder='big', signed=False)
-        return perceptual_hash
+        return get_features(filename, file_hash)['phash'][0]
     except cv2.error as e:
         print(e)
 
-def rotate_hash(filename):
+def rotate_hash(filename, file_hash=None):
     try:
-        #imread = cv2.cvtColor(cv2.imread(filename), cv2.IMREAD_IGNORE_ORIENTATION, cv2.COLOR_BGR2GRAY)
-        src = cv2.imread(filename, cv2.IMREAD_IGNORE_ORIENTATION)
-        imread = cv2.rotate(src, cv2.ROTATE_90_CLOCKWISE)
-        imhash = cv2.img_hash.pHash(imread) # 8-byte hash
-        rotated_hash = int.from_bytes(imhash.tobytes(), byteorder='big', signed=False)
-        print(rotated_hash)
-        imread = cv2.rotate(src, cv2.ROTATE_180)
-        imhash = cv2.img_hash.pHash(imread) # 8-byte hash
-        rotated_hash = int.from_bytes(imhash.tobytes(), byteorder='big', signed=False)
-        print(rotated_hash)
-        imread = cv2.rotate(src, cv2.ROTATE_90_COUNTERCLOCKWISE)
-        imhash = cv2.img_hash.pHash(imread) # 8-byte hash
-        rotated_hash = int.from_bytes(imhash.tobytes(), byteorder='big', signed=False)
-        print(rotated_hash)
+        phash = get_features(filename, file_hash)['phash']
+        # Clockwise, upside down and counter clockwise
+        for rotation in (1, 3, 2):
+            print(phash[rotation])
         return
     except cv2.error as e:
         print(e)
 
+# Images whose perceptual hashes differ by more bits than this are not compared any further
+phash_limit = 12
+
+# Function to compare two images from the cheapest check to the most expensive, returning
+# whether they match and a description of the check which decided it. Images with different
+# aspect ratios or distant perceptual hashes are rejected before any structural similarity,
+# which is computed on the cached thumbnails so the originals are only read to hash them.
+@stages.timed('compare')
+def compare_images(filename, other):
+    _, width, height = read_exif_header(filename)
+    _, other_width, other_height = read_exif_header(other)
+    if width and other_width and abs(width / height - other_width / other_height) > 0.01:
+        return False, f"Dimensions differ: {width}x{height} and {other_width}x{other_height}"
+    features = get_features(filename)
+    other_features = get_features(other)
+    distance = bin(features['phash'][0] ^ other_features['phash'][0]).count("1")
+    if distance > phash_limit:
+        return False, f"Perceptual hash distance: {distance}"
+    ss = ssim(features['thumbnail'], other_features['thumbnail'], data_range=255)
+    return ss >= args.ssim_threshold, f"Structural similarity: {ss}"
+
 def is_empty_string(s):
     return s.isspace()
 
+# Function to list the files under a directory recursively in a single pass, excluding hidden
+# files, the ignored names and the target directory
+def walk_files(directory):
+    scanner = Scanner([name for name in args.ignore.split(",") if name], exclude=[args.target] if args.target else ())
+    return [entry.path for entry in scanner.walk(directory)]
+
+# Function to plan the rename of an image from its EXIF header, returning the new file name and
+# the EXIF bytes with the original file name stored in them, or None if the image is skipped
+@stages.timed('plan')
+def plan_rename(file_path):
+    messages = []
+    # Get the original date and time from the EXIF header, without opening the image
+    exif_dict = None
+    try:
+        exif, _, _ = read_exif_header(file_path)
+    except OSError as e:
+        messages.append(f"\033[31m\u25E6 ERROR: {e}\033[0m")
+        exif = None
+    if exif is None:
+        messages.append(f"\033[31m\u25E6 ERROR: EXIF metadata missing \033[0m")
+    else:
+        exif_dict = check_exif(piexif.load(exif))
+    if exif_dict is None:
+        # If the EXIF metadata is missing, skip the image
+        messages.append(f"\033[35m\u25E6 WARN: Skipped file {file_path}\033[0m")
+        return {'source': file_path, 'name': None, 'messages': messages}
+    if piexif.ExifIFD.DateTimeOriginal in exif_dict["Exif"]:
+        date_time_str = exif_dict["Exif"][piexif.ExifIFD.DateTimeOriginal].decode("utf-8")
+        # Handle exception when original data time is missing
+        if is_empty_string(date_time_str):
+            messages.append(f"\033[35m\u25E6 WARN: original date time missing from EXIF metadata\033[0m")
+            date_time_str = exif_dict["0th"][piexif.ImageIFD.DateTime].decode("utf-8")
+        messages.append(f"\033[32m\u25E6 Image Date/Time: {date_time_str}\033[0m")
+        date_time_obj = datetime.datetime.strptime(date_time_str, '%Y:%m:%d %H:%M:%S')
+        date = date_time_obj.strftime('%Y-%m-%d_%H%M%S')
+    else:
+        # If no EXIF data is available, use the file's creation time instead
+        timestamp = os.path.getctime(file_path)
+        date = datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d_%H%M%S')
+    # Get the original file name and store it in the EXIF metadata
+    try:
+        original_filename = exif_dict["0th"][piexif.ImageIFD.ImageDescription].decode("utf-8")
+    except KeyError:
+        # If the ImageDescription tag is not present, use the original filename instead
+        original_filename = os.path.basename(file_path)
+    exif_dict["0th"][piexif.ImageIFD.ImageDescription] = original_filename.encode("utf-8")
+    try:
+        # Convert the exif_dict to a byte array
+        exif_bytes = piexif.dump(exif_dict)
+    # If an error occurs, remove the exif_dict and convert it to a byte array
+    except ValueError as e:
+        messages.append(f"\033[31m\u25E6 ERROR: ValueError {e}\033[0m")
+        # Remove the exif_dict from the exif_dict
+        exif_dict = piexif.remove(exif_dict)
+        # Convert the exif_dict to a byte array
+        exif_bytes = piexif.dump(exif_dict)
+    # Construct the new file name
+    suffix = args.suffix if args.suffix else ""
+    name = f"{date}{suffix}{os.path.splitext(file_path)[1]}"
+    return {'source': file_path, 'name': name, 'exif_bytes': exif_bytes, 'messages': messages}
+
+# Function to return the device of a directory, or of its nearest parent if it doesn't exist yet
+def get_device(directory):
+    while not os.path.exists(directory):
+        directory = os.path.dirname(directory)
+    return os.stat(directory).st_dev
+
+# Function to choose the destination of every planned rename. Conflicts are found against one
+# listing of each destination directory and the names already planned, rather than checking
+# the disk for every file. Moves to another device are marked so they can be batched.
+def resolve_destinations(steps):
+    existing = {}
+    planned = {}
+    devices = {}
+    for step in steps:
+        if step['name'] is None:
+            step['action'] = 'skip'
+            continue
+        directory = args.target if args.target else os.path.dirname(step['source'])
+        if directory not in existing:
+            existing[directory] = set(os.listdir(directory)) if os.path.isdir(directory) else set()
+            planned[directory] = set()
+            devices[directory] = get_device(directory)
+        step['destination'] = os.path.join(directory, step['name'])
+        if step['destination'] == step['source']:
+            step['action'] = 'unchanged'
+        elif step['name'] in existing[directory]:
+            step['action'] = 'conflict'
+        else:
+            # Images taken in the same second in this run get a numeric suffix
+            stem, extension = os.path.splitext(step['name'])
+            count = 0
+            while step['name'] in planned[directory] or step['name'] in existing[directory]:
+                count += 1
+                step['name'] = f"{stem}-{count}{extension}"
+            planned[directory].add(step['name'])
+            step['destination'] = os.path.join(directory, step['name'])
+            step['action'] = 'move'
+            step['cross_device'] = os.stat(step['source']).st_dev != devices[directory]
+    return steps
+
+# Function to write the original file name to the EXIF metadata of an image, the image data is
+# left untouched so the file isn't re-encoded
+def write_original_filename(step):
+    try:
+        with stages.time('write_exif'):
+            write_exif_header(step['source'], step['exif_bytes'])
+    except (IOError, ValueError):
+        raise IOError(f"\033[31m\u25E6 ERROR: failed to write EXIF metadata to {step['source']}\033[0m")
+
+# Function to carry out a planned move
+def execute_move(step, journal):
+    write_original_filename(step)
+    os.makedirs(os.path.dirname(step['destination']), exist_ok=True)
+    # Journal the move before it's made so it can be undone even if the run is interrupted
+    journal.write({'source': os.path.abspath(step['source']), 'destination': os.path.abspath(step['destination']), 'cross_device': step['cross_device']})
+    with stages.time('move_cross_device' if step['cross_device'] else 'move'):
+        if step['cross_device']:
+            shutil.move(step['source'], step['destination'])
+        else:
+            os.rename(step['source'], step['destination'])
+    return step
+
+# Function to read the journal of an interrupted run, returning the destinations of the moves it
+# made. A copy to another device which was cut off part way is removed so it's made again, a
+# rename on one device is atomic so it never leaves one.
+def resume_moves(journal_path):
+    moved = set()
+    for entry in read_journal(journal_path):
+        if is_moved(entry):
+            moved.add(entry['destination'])
+        elif entry.get('cross_device') and os.path.exists(entry['source']) and os.path.exists(entry['destination']) and os.path.getsize(entry['destination']) < os.path.getsize(entry['source']):
+            os.remove(entry['destination'])
+            print(f"\033[35m\u25E6 WARN: Removed partial copy {entry['destination']}\033[0m")
+    return moved
+
+# Function to move the files in a rename journal back to their original names, newest first
+def undo_rename(journal_path):
+    restored_count = 0
+    for entry in undo_moves(journal_path):
+        print(f"\033[36m\u25E6 OK: Restored {entry['destination']} to {entry['source']}\033[0m")
+        restored_count += 1
+    print(f"\033[32mRestored: {restored_count}\033[0m")
+
+# Function to compare an image with the existing file it conflicts with in the target directory,
+# returning True if the image was an identical copy and has been removed
+def resolve_conflict(step):
+    source = step['source']
+    output_path = step['destination']
+    write_original_filename(step)
+    if is_identical(source, output_path):
+        print(f"\033[33m\u25E6 Hash match?: True\033[0m")
+        os.remove(source)
+        print(f"\033[35m\u25E6 WARN: Removed identical source file {source}\033[0m")
+        return True
+    print(f"\033[33m\u25E6 Hash match?: False\033[0m")
+    try:
+        match, result = compare_images(source, output_path)
+        print(f"\033[33m\u25E6 {result}\033[0m")
+        if match:
+            os.remove(source)
+            print(f"\033[33m\u25E6 Removed identical source file {source}\033[0m")
+            return True
+    except (OSError, ValueError, cv2.error) as e:
+        print(e)
+        print(f"\033[33m\u25E6 Structural Similarity: Not calculated\033[0m")
+    return False
+
+# Function to rename and organize images. A plan of every rename is built first, reading the
+# EXIF headers across a thread pool, then the moves are carried out across the pool with moves
+# to another device batched at the end, one at a time, so they stream over the network rather
+# than competing for it. Each move is written to a journal first, which --undo reverses and
+# --resume continues. Returns the number of skipped and duplicate images.
+def organize(images):
+    skip_count = 0
+    dupe_count = 0
+    if args.resume:
+        # The images an interrupted run already moved are left where they are
+        moved = resume_moves(args.resume)
+        images = [f for f in images if os.path.abspath(f) not in moved]
+        print(f"\033[32mResuming After: {len(moved)}\033[0m")
+        journal_path = args.resume
+    else:
+        journal_path = os.path.join(os.path.expanduser("~"), "rename-" + datetime.datetime.now().strftime('%Y%m%d_%H%M%S') + ".jsonl")
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        steps = resolve_destinations(list(executor.map(plan_rename, images)))
+    for image_count, step in enumerate(steps, 1):
+        print(f"\033[32mProcessing: {image_count} of {len(steps)} ({step['source']})\033[0m")
+        for message in step['messages']:
+            print(message)
+        if step['action'] == 'skip':
+            skip_count += 1
+        elif step['action'] == 'conflict':
+            print(f"\033[35m\u25E6 WARN: Filename already exists: {step['destination']}\033[0m")
+            # Handle conflicts by comparing with the existing file when moving to a target, or skipping the file on this run
+            if args.target and resolve_conflict(step):
+                dupe_count += 1
+            else:
+                skip_count += 1
+                print(f"\033[35m\u25E6 WARN: Skipped file {step['source']}\033[0m")
+    moves = [step for step in steps if step['action'] == 'move' and not step['cross_device']]
+    cross_device_moves = [step for step in steps if step['action'] == 'move' and step['cross_device']]
+    if not moves and not cross_device_moves:
+        return skip_count, dupe_count
+    # A move which fails is skipped, the others carry on and stay in the journal
+    try:
+        with Journal(journal_path) as journal:
+            with ThreadPoolExecutor(max_workers=args.threads) as executor:
+                futures = {executor.submit(execute_move, step, journal): step for step in moves}
+                for future in as_completed(futures):
+                    step = futures[future]
+                    try:
+                        future.result()
+                    except OSError as e:
+                        skip_count += 1
+                        print(e)
+                        print(f"\033[35m\u25E6 WARN: Skipped file {step['source']}\033[0m")
+                        continue
+                    print(f"\033[36m\u25E6 OK: Renamed {step['source']} to {step['destination']}\033[0m")
+            for step in cross_device_moves:
+                try:
+                    execute_move(step, journal)
+                except OSError as e:
+                    skip_count += 1
+                    print(e)
+                    print(f"\033[35m\u25E6 WARN: Skipped file {step['source']}\033[0m")
+                    continue
+                print(f"\033[36m\u25E6 OK: Moved {step['source']} to {step['destination']}\033[0m")
+    finally:
+        print(f"\033[32mUndo Journal: {journal_path}\033[0m")
+    return skip_count, dupe_count
+
 def main():
+    if args.undo:
+        undo_rename(args.undo)
+        return
+
     # Initialize image counter
     image_count = 0
     video_count = 0
@@ -112,20 +413,32 @@ def main():
     file_dict = {}
     img_dict = {}
 
-    # Loop through all files in the directory
-    image_total = len([f for f in os.listdir(args.directory) if is_image(f)])
+    # Walk the directory once and find the images and videos in it
+    files = walk_files(args.directory)
+    if args.compare or args.dedupe:
+        images = [f for f in files if is_image(f)]
+    else:
+        # Other formats are left alone until their date can be read
+        images = [f for f in files if is_jpeg(f)]
+    videos = [f for f in files if is_video(f)]
+    image_total = len(images)
+    # Read the EXIF metadata of every image up front across a thread pool
+    if args.dedupe:
+        metadata_cache.extract([os.path.abspath(f) for f in images], args.threads)
+    # Read the creation time of every video in batches through one exiftool process
+    metadata_cache.extract([os.path.abspath(f) for f in videos])
 
-    for index, filename in enumerate(sorted(os.listdir(args.directory))):    
-        if is_image(filename):
+    if args.compare or args.dedupe:
+        for filename in images:
             # Increment image count
             image_count += 1
             print(f"\033[32mProcessing: {image_count} of {image_total} ({filename})\033[0m")
             if args.compare:
                 if args.target:
-                    output_path = os.path.join(args.target, filename)
+                    output_path = os.path.join(args.target, os.path.basename(filename))
                     if os.path.exists(output_path):
                         print(f"\033[35m\u25E6 WARN: Filename already exists: {filename}\033[0m")
-                        if hash_file(filename) == hash_file(output_path):
+                        if is_identical(filename, output_path):
                             print(f"\033[33m\u25E6 Hash match?: True\033[0m")
                             os.remove(filename)
                             dupe_count += 1
@@ -133,21 +446,13 @@ def main():
                         else:
                             print(f"\033[33m\u25E6 Hash match?: False\033[0m")
                             try:
-                                #src = cv2.cvtColor(cv2.imread(filename), cv2.IMREAD_IGNORE_ORIENTATION, cv2.COLOR_BGR2GRAY)
-                                #dst = cv2.cvtColor(cv2.imread(output_path), cv2.IMREAD_IGNORE_ORIENTATION, cv2.COLOR_BGR2GRAY)
-                                src = cv2.imread(filename, cv2.IMREAD_IGNORE_ORIENTATION)
-                                dst = cv2.imread(output_path, cv2.IMREAD_IGNORE_ORIENTATION)
-                                print(src.shape)
-                                print(dst.shape)
-                                ss = ssim(src, dst)
-                                if ss == 1.0:
-                                    print(f"\033[33m\u25E6 Structural similarity?: True\033[0m")
+                                match, result = compare_images(filename, output_path)
+                                print(f"\033[33m\u25E6 {result}\033[0m")
+                                if match:
                                     dupe_count += 1
                                     os.remove(filename)
                                     print(f"\033[33m\u25E6 Removed identical source file {filename}\033[0m")
-                                else:
-                                    print(f"\033[33m\u25E6 Structural similarity: {ss}\033[0m")
-                            except ValueError as e:
+                            except (OSError, ValueError, cv2.error) as e:
                                 print(e)
                                 print(f"\033[33m\u25E6 Structural Similarity: Not calculated\033[0m")
             elif args.dedupe:
@@ -158,10 +463,10 @@ def main():
                 #print(is_exif(filename))
                 if is_camera(filename):
                     #print(f"\033[33m\u25E6 Exif: ✓ Camera: ✓ \033[0m")
-                    file_hash = hash_file(filename)
-                    img_hash = perceptual_hash(filename)
+                    file_hash = get_hash(filename)
+                    img_hash = perceptual_hash(filename, file_hash)
                     print(img_hash)
-                    rotate_hash(filename)
+                    rotate_hash(filename, file_hash)
                     if file_hash in file_dict:
                         dupe_count += 1
                         print(f"\033[33m\u25E6 File hash found: {filename} and {file_dict[file_hash]}")
@@ -174,130 +479,13 @@ def main():
                         img_dict[img_hash] = filename
                 else:
                     print("Send this image to trash for review")
-                # if file_hash in hash_dict:
-                #     # Duplicate found, print the paths of both files
-                #     dupe_count += 1
-                #     print(f"\033[33m\u25E6 Duplicate found: {filename} and {hash_dict[file_hash]}")
-                # else:
-                #     hash_dict[file_hash] = filename
-                # if cv2_hash in cv2_dict:
-                #     # Duplicate found, print the paths of both files
-                #     dupe_count += 1
-                #     print(f"\033[33m\u25E6 Rotated duplicate found: {filename} and {cv2_hash[file_hash]}")
-                # else:
-                #     cv2_hash[file_hash] = filename
-                #print(f"\033[33m\u25E6 Filename: {filename}\033[0m")
-            else:
-                # Open the image and get the original date and time from the EXIF metadata
-                with Image.open(os.path.join(args.directory, filename)) as image:
-                    exif_dict = None
-                    try:
-                        exif_dict = piexif.load(image.info["exif"])
-                        exif_dict = check_exif(exif_dict)
-                    except KeyError as e:
-                        print(f"\033[31m\u25E6 ERROR: KeyError {e} \033[0m")
-                    if exif_dict is None:
-                        # If the EXIF metadata is missing, skip the image
-                        skip_count += 1
-                        print(f"\033[35m\u25E6 WARN: Skipped file {new_filename}\033[0m")
-                    else:
-                        if exif_dict and piexif.ExifIFD.DateTimeOriginal in exif_dict["Exif"]:
-                            date_time_str = exif_dict["Exif"][piexif.ExifIFD.DateTimeOriginal].decode("utf-8")
-                            # Handle exception when original data time is missing
-                            if is_empty_string(date_time_str):
-                                print(f"\033[35m\u25E6 WARN: original date time missing from EXIF metadata\033[0m")
-                                date_time_str = exif_dict["0th"][piexif.ImageIFD.DateTime].decode("utf-8")
-                            print(f"\033[32m\u25E6 Image Date/Time: {date_time_str}\033[0m")
-                            #input("Press Enter to continue...")
-                            date_time_obj = datetime.datetime.strptime(date_time_str, '%Y:%m:%d %H:%M:%S')
-                            date = date_time_obj.strftime('%Y-%m-%d_%H%M%S')
-                        else:
-                            # If no EXIF data is available, use the file's creation time instead
-                            timestamp = os.path.getctime(os.path.join(args.directory, filename))
-                            date = datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d_%H%M%S')
-                        # Get the original file name and store it in the EXIF metadata
-                        try:
-                            original_filename = exif_dict["0th"][piexif.ImageIFD.ImageDescription].decode("utf-8")
-                        except KeyError:
-                            # If the ImageDescription tag is not present, use the original filename instead
-                            original_filename = os.path.basename(filename)
-                        try:
-                            exif_dict["0th"][piexif.ImageIFD.ImageDescription] = original_filename.encode("utf-8")
-                        except KeyError as e:
-                            print(f"\033[31m\u25E6 ERROR: KeyError {e}\033[0m")
-                        try:
-                            # Convert the exif_dict to a byte array
-                            exif_bytes = piexif.dump(exif_dict)
-                        # If an error occurs, remove the exif_dict and convert it to a byte array
-                        except ValueError as e:
-                            print(f"\033[31m\u25E6 ERROR: ValueError {e}\033[0m")
-                            # Remove the exif_dict from the exif_dict
-                            exif_dict = piexif.remove(exif_dict)
-                            # Convert the exif_dict to a byte array
-                            exif_bytes = piexif.dump(exif_dict)
-            
-                        # Construct the new file name and path
-                        suffix = args.suffix if args.suffix else ""
-                        new_filename = f"{date}{suffix}{os.path.splitext(filename)[1]}"
-                        new_file_path = os.path.join(args.directory, new_filename)
-
-                        # Handle conflicts by skipping the file on this run
-                        if os.path.exists(new_file_path):
-                            skip_count += 1
-                            print(f"\033[35m\u25E6 WARN: Filename already exists: {new_file_path}\033[0m")
-                        else:
-                            # Rename the file and move it to the new path
-                            os.rename(os.path.join(args.directory, filename), new_file_path)
-                            # Write the original file name to the EXIF metadata of the new file
-                            with Image.open(new_file_path) as image:
-                                try:
-                                    image.save(new_file_path, exif=exif_bytes)
-                                    print(f"\033[36m\u25E6 OK: Renamed {filename} to {new_filename}\033[0m")
-                                except IOError:
-                                    raise IOError(f"\033[31m\u25E6 ERROR: failed to write EXIF metadata to {new_file_path}\033[0m")
-                                
-                            # Move the file to a new directory if specified
-                            if args.target:
-                                output_path = os.path.join(args.target, new_filename)
-                                os.makedirs(args.target, exist_ok=True)
-                                if os.path.exists(output_path):
-                                    print(f"\033[35m\u25E6 WARN: Filename already exists: {new_filename}\033[0m")
-                                    if os.stat(new_file_path) == os.stat(output_path):
-                                        print(f"\033[33m\u25E6 Stat match?: True\033[0m")
-                                        raise FileExistsError(f"Identical file exists in taarget directory: {new_filename}")
-                                    else:
-                                        print(f"\033[33m\u25E6 Stat match?: False\033[0m")
-                                    if hash_file(new_file_path) == hash_file(output_path):
-                                        print(f"\033[33m\u25E6 Hash match?: True\033[0m")
-                                        os.remove(new_file_path)
-                                        dupe_count += 1
-                                        print(f"\033[35m\u25E6 WARN: Removed identical source file {new_filename}\033[0m")
-                                    else:
-                                        print(f"\033[33m\u25E6 Hash match?: False\033[0m")
-                                        try:
-                                            src = cv2.cvtColor(cv2.imread(new_file_path), cv2.COLOR_BGR2GRAY)
-                                            dst = cv2.cvtColor(cv2.imread(output_path), cv2.COLOR_BGR2GRAY)
-                                            ss = ssim(src, dst)
-                                            if ss == 1.0:
-                                                print(f"\033[33m\u25E6 Structural similarity?: True\033[0m")
-                                                dupe_count += 1
-                                                os.remove(new_file_path)
-                                                print(f"\033[33m\u25E6 Removed identical source file {new_filename}\033[0m")
-                                            else:
-                                                print(f"\033[33m\u25E6 Structural similarity: {ss}\033[0m")
-                                        except ValueError:
-                                            print(f"\033[33m\u25E6 Structural Similarity: Not calculated\033[0m")
-                                    # Increment skipped image count
-                                    skip_count += 1
-                                    print(f"\033[35m\u25E6 WARN: Skipped file {new_filename}\033[0m")
-                                else:
-                                    os.rename(new_file_path, output_path)
-                                    print(f"\033[36m\u25E6 OK: Moved {new_filename} to {args.target}\033[0m")
-
-        elif is_video(filename):
-            video_count += 1
-            creation_time = get_mp4_creation_time(filename)
-            print(f"MP4 Filename: {filename} Creation Time: {creation_time}")
+    else:
+        skip_count, dupe_count = organize(images)
+
+    for filename in videos:
+        video_count += 1
+        creation_time = get_video_creation_time(filename)
+        print(f"Video Filename: {filename} Creation Time: {creation_time}")
 
     # Print skipped image count
     print(f"\033[32mTotal Images: {image_total}\033[0m")
@@ -306,4 +494,9 @@ def main():
     print(f"\033[32mTotal Videos: {video_count}\033[0m")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    with profile(args.profile, os.path.join(os.path.expanduser("~"), "profile-rename-" + datetime.datetime.now().strftime('%Y%m%d_%H%M%S'))):
+        main()
+    if args.metrics:
+        stages.write(args.metrics, "rename")
+    metadata_cache.close()
+    thumbnail_cache.flush()
@@ -0,0 +1,78 @@
+import os
+
+# Names skipped by default besides hidden files, the thumbnail folders and recycle bins Synology
+# keeps beside the photos on a NAS share
+ignored_names = ('@eaDir', '#recycle', '#snapshot')
+
+# Walker shared by image-ai.py and rename.py. Each directory is listed once with os.scandir and
+# its DirEntry objects are handed on, so the file type comes from the listing and the stat of
+# a file is only read once, when a consumer asks for it.
+class Scanner:
+    def __init__(self, ignore=ignored_names, extensions=None, hidden=False, exclude=()):
+        self.ignore = set(ignore)
+        # An optional tuple of lower case extensions, the only files the walk returns
+        self.extensions = tuple(extensions) if extensions else None
+        self.hidden = hidden
+        # Directories which are never entered, such as the target of a move
+        self.exclude = {os.path.abspath(path) for path in exclude}
+        # The directories the last walk couldn't list, and the files a consumer couldn't stat, so
+        # the files in them are never mistaken for deleted ones
+        self.failed = []
+
+    # Function to check if a file or directory name is skipped
+    def is_ignored(self, name):
+        return (not self.hidden and name[0] == '.') or name in self.ignore
+
+    # Function to check if a file name passes the extension filter
+    def is_included(self, name):
+        return self.extensions is None or name.lower().endswith(self.extensions)
+
+    # Function to list one directory, returning the entries of its files and the paths of its
+    # subdirectories, both sorted by name
+    def scan(self, directory):
+        files = []
+        subdirs = []
+        with os.scandir(directory) as entries:
+            for entry in sorted(entries, key=lambda entry: entry.name):
+                if self.is_ignored(entry.name):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    if os.path.abspath(entry.path) not in self.exclude:
+                        subdirs.append(entry.path)
+                elif entry.is_file() and self.is_included(entry.name):
+                    files.append(entry)
+        return files, subdirs
+
+    # Function to walk a directory tree depth first in a single pass, yielding the entry of
+    # every file. The total of an optional progress bar grows as each directory is listed.
+    def walk(self, directory, pbar=None):
+        self.failed = []
+        stack = [directory]
+        while stack:
+            path = stack.pop()
+            try:
+                files, subdirs = self.scan(path)
+            except OSError as e:
+                print(e)
+                self.failed.append(path)
+                continue
+            if pbar is not None:
+                pbar.total += len(files)
+                pbar.refresh()
+            yield from files
+            stack.extend(reversed(subdirs))
+
+    # Function to check if a path is one the last walk couldn't list or stat, or is below one
+    def is_unlisted(self, path):
+        return any(path == failed or path.startswith(os.path.join(failed, "")) for failed in self.failed)
+
+    # Function to walk a directory tree yielding every directory in it, including the first
+    def walk_directories(self, directory):
+        stack = [directory]
+        while stack:
+            path = stack.pop()
+            yield path
+            try:
+                stack.extend(reversed(self.scan(path)[1]))
+            except OSError as e:
+                print(e)
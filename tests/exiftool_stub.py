@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+# Stand-in for exiftool which speaks its -stay_open protocol: arguments are read one per line from
+# the argument file on stdin, each -execute runs the command read so far, and its output ends in
+# a {ready} line. A command prints the requested tags of each file as pretty-printed JSON, like
+# exiftool -json, skips files whose name contains "missing" and exits at one containing "crash".
+import json
+import sys
+
+def run(args):
+    tags = [arg[1:] for arg in args if arg.startswith("-") and arg not in ("-json", "-n")]
+    records = []
+    for path in [arg for arg in args if not arg.startswith("-")]:
+        if "crash" in path:
+            sys.exit(1)
+        if "missing" in path:
+            continue
+        record = {"SourceFile": path}
+        for tag in tags:
+            record[tag] = {"CreateDate": "2020:01:02 03:04:05", "ImageWidth": 1920, "ImageHeight": 1080}.get(tag, "Stub")
+        records.append(record)
+    if records:
+        print(json.dumps(records, indent=2))
+    print("{ready}", flush=True)
+
+def main():
+    if sys.argv[1:] != ["-stay_open", "True", "-@", "-"]:
+        sys.exit(2)
+    args = []
+    for line in sys.stdin:
+        line = line.rstrip("\n")
+        if line == "-execute":
+            run(args)
+            args = []
+        elif args == ["-stay_open"] and line == "False":
+            return
+        else:
+            args.append(line)
+
+if __name__ == "__main__":
+    main()
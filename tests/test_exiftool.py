@@ -0,0 +1,87 @@
+import os
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from metadata import ExifTool, MetadataCache
+
+# Fake exiftool speaking the -stay_open protocol, see exiftool_stub.py
+stub = os.path.join(os.path.dirname(os.path.abspath(__file__)), "exiftool_stub.py")
+
+class ExifToolTest(unittest.TestCase):
+    def setUp(self):
+        self.exiftool = ExifTool(stub)
+
+    def tearDown(self):
+        self.exiftool.close()
+
+    def test_execute_returns_output_before_ready(self):
+        output = self.exiftool.execute("-json", "a.mp4")
+        self.assertIn('"SourceFile": "a.mp4"', output)
+        self.assertNotIn("{ready}", output)
+
+    def test_get_tags_parses_json(self):
+        tags = self.exiftool.get_tags(["a.mp4", "b.mov"], ("CreateDate", "ImageWidth"))
+        self.assertEqual([record["SourceFile"] for record in tags], ["a.mp4", "b.mov"])
+        self.assertEqual(tags[0]["CreateDate"], "2020:01:02 03:04:05")
+        self.assertEqual(tags[1]["ImageWidth"], 1920)
+
+    def test_commands_share_one_process(self):
+        process = self.exiftool.process
+        for name in ("a.mp4", "b.mp4", "c.mp4"):
+            self.assertEqual(self.exiftool.get_tags([name], ("CreateDate",))[0]["SourceFile"], name)
+        self.assertIs(self.exiftool.process, process)
+        self.assertIsNone(process.poll())
+
+    def test_get_tags_without_output(self):
+        self.assertEqual(self.exiftool.get_tags(["missing.mp4"], ("CreateDate",)), [])
+        # The next command still gets its own output
+        self.assertEqual(len(self.exiftool.get_tags(["a.mp4"], ("CreateDate",))), 1)
+
+    def test_exit_raises_oserror(self):
+        with self.assertRaises(OSError):
+            self.exiftool.get_tags(["crash.mp4"], ("CreateDate",))
+
+    def test_close_stops_process(self):
+        self.exiftool.close()
+        self.assertEqual(self.exiftool.process.returncode, 0)
+
+class ExtractVideosTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = MetadataCache(sqlite3.connect(os.path.join(self.directory.name, "index.sqlite")), stub)
+
+    def tearDown(self):
+        self.cache.close()
+        self.directory.cleanup()
+
+    def create_videos(self, *names):
+        paths = []
+        for name in names:
+            paths.append(os.path.join(self.directory.name, name))
+            with open(paths[-1], "wb") as f:
+                f.write(b"video")
+        return paths
+
+    def test_extract_stores_video_metadata(self):
+        paths = self.create_videos("a.mp4", "b.mov", "missing.mp4")
+        self.assertEqual(self.cache.extract(paths), 3)
+        metadata = self.cache.lookup(paths[0])
+        self.assertEqual(metadata['date_taken'], "2020:01:02 03:04:05")
+        self.assertEqual((metadata['width'], metadata['height']), (1920, 1080))
+        self.assertIsNotNone(self.cache.lookup(paths[1]))
+        # A file exiftool returned nothing for isn't cached
+        self.assertIsNone(self.cache.lookup(paths[2]))
+
+    def test_extract_restarts_exiftool_after_crash(self):
+        crash, video = self.create_videos("crash.mp4", "a.mp4")
+        self.cache.extract([crash])
+        self.assertIsNone(self.cache.exiftool)
+        self.cache.extract([video])
+        self.assertEqual(self.cache.lookup(video)['date_taken'], "2020:01:02 03:04:05")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,255 @@
+import cv2
+import numpy as np
+import time
+from metadata import read_exif_header
+from metrics import stages
+
+# HEIC and RAW files are decoded through optional packages, the other formats through OpenCV
+try:
+    import pillow_heif
+except ImportError:
+    pillow_heif = None
+try:
+    import rawpy
+except ImportError:
+    rawpy = None
+
+# The size of the grayscale thumbnail kept for each image, large enough for structural
+# similarity and downscaled again to the 32x32 input of the perceptual hash
+thumbnail_size = 128
+# The number of bins in the histogram of each colour channel
+histogram_bins = 16
+# The default size cap of the cache file
+cache_bytes = 1024 * 1024 * 1024
+
+# Each cached image is a fixed size record, so a record is found by its slot number alone. The
+# hash is stored in the record too, so a slot reused by another image is never mistaken for it.
+entry = np.dtype([
+    # Raw bytes rather than 'S32', which numpy reads back with trailing zero bytes stripped
+    ('hash', np.uint8, (32,)),
+    ('thumbnail', np.uint8, (thumbnail_size, thumbnail_size)),
+    ('phash', np.uint64, (4,)),
+    ('width', np.uint32),
+    ('height', np.uint32),
+    ('histogram', np.float32, (3 * histogram_bins,))
+])
+
+# The ISO base media brands of HEIF images, and of Canon's CR3 RAW files
+heif_brands = (b"heic", b"heix", b"hevc", b"hevx", b"heim", b"heis", b"mif1", b"msf1")
+raw_brands = (b"crx ",)
+
+# Function to return the format of an image from its magic bytes, None if it isn't an image
+def sniff_format(file_path):
+    try:
+        with open(file_path, "rb") as f:
+            header = f.read(16)
+    except OSError:
+        return None
+    if header.startswith(b"\xff\xd8\xff"):
+        return 'jpeg'
+    if header.startswith(b"\x89PNG\r\n\x1a\n"):
+        return 'png'
+    if header.startswith(b"RIFF") and header[8:12] == b"WEBP":
+        return 'webp'
+    if header[4:8] == b"ftyp" and header[8:12] in heif_brands:
+        return 'heif'
+    if header[4:8] == b"ftyp" and header[8:12] in raw_brands:
+        return 'raw'
+    # CR2, NEF, ARW and DNG are TIFF files, ORF, RW2 and RAF have their own signatures
+    if header.startswith((b"II*\x00", b"MM\x00*", b"IIRO", b"IIU\x00", b"FUJIFILMCCD-RAW")):
+        return 'raw'
+    return None
+
+# Function to check if a file is an image in one of the formats which can be decoded
+def is_image(file_path):
+    return sniff_format(file_path) is not None
+
+# Function to downscale a decoded image to an eighth of its size, as a reduced decode would
+def reduce_image(image):
+    return cv2.resize(image, (max(1, image.shape[1] // 8), max(1, image.shape[0] // 8)), interpolation=cv2.INTER_AREA)
+
+# Function to convert an image decoded by another library to OpenCV's BGR channel order
+def to_bgr(image, mode):
+    conversions = {'RGB': cv2.COLOR_RGB2BGR, 'RGBA': cv2.COLOR_RGBA2BGR, 'BGRA': cv2.COLOR_BGRA2BGR, 'L': cv2.COLOR_GRAY2BGR}
+    image = np.asarray(image)
+    return cv2.cvtColor(image, conversions[mode]) if mode in conversions else image
+
+# Each decoder takes the cheapest route to a small image and returns it with the dimensions of the
+# full image. JPEGs are decoded at an eighth of their resolution by libjpeg.
+def decode_jpeg(file_path):
+    image = cv2.imread(file_path, cv2.IMREAD_REDUCED_COLOR_8 | cv2.IMREAD_IGNORE_ORIENTATION)
+    if image is None:
+        return None, None, None
+    try:
+        _, width, height = read_exif_header(file_path)
+    except OSError as e:
+        raise cv2.error(str(e))
+    if width is None:
+        height, width = image.shape[0] * 8, image.shape[1] * 8
+    return image, width, height
+
+# PNG and WebP have no reduced decode so they are decoded in full and downscaled
+def decode_image(file_path):
+    image = cv2.imread(file_path, cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+    if image is None:
+        return None, None, None
+    return reduce_image(image), image.shape[1], image.shape[0]
+
+# HEIC files usually carry a thumbnail which is decoded instead of the primary image. Errors from
+# libheif are raised as cv2.error like the failures of the other decoders.
+def decode_heif(file_path):
+    if pillow_heif is None:
+        raise cv2.error("pillow-heif is required to decode " + file_path)
+    try:
+        heif_file = pillow_heif.open_heif(file_path)
+        primary = heif_file[heif_file.primary_index]
+        width, height = primary.size
+        thumbnails = primary.info.get("thumbnails") or []
+        if thumbnails:
+            # Take the largest thumbnail, libheif only decodes what is accessed
+            image = primary.get_thumbnail(thumbnails.index(max(thumbnails)))
+            return to_bgr(image, image.mode), width, height
+        return reduce_image(to_bgr(primary, primary.mode)), width, height
+    except (OSError, RuntimeError, ValueError) as e:
+        raise cv2.error(str(e))
+
+# RAW files have their embedded preview JPEG decoded rather than the sensor data developed
+def decode_raw(file_path):
+    if rawpy is None:
+        # Plain TIFFs and some RAW files still decode through OpenCV
+        return decode_image(file_path)
+    try:
+        with rawpy.imread(file_path) as raw:
+            width, height = raw.sizes.width, raw.sizes.height
+            thumb = raw.extract_thumb()
+    except rawpy.LibRawError:
+        return decode_image(file_path)
+    if thumb.format == rawpy.ThumbFormat.JPEG:
+        image = cv2.imdecode(np.frombuffer(thumb.data, np.uint8), cv2.IMREAD_REDUCED_COLOR_4 | cv2.IMREAD_IGNORE_ORIENTATION)
+    else:
+        image = reduce_image(to_bgr(thumb.data, 'RGB'))
+    return image, width, height
+
+decoders = {
+    'jpeg': decode_jpeg,
+    'png': decode_image,
+    'webp': decode_image,
+    'heif': decode_heif,
+    'raw': decode_raw
+}
+
+# Function to compute the perceptual hash of a 32x32 image and its three rotations
+def rotation_hashes(imread):
+    phash = {}
+    imhash = cv2.img_hash.pHash(imread) # 8-byte hash
+    phash[0] = int.from_bytes(imhash.tobytes(), byteorder='big', signed=False)
+    imread = cv2.rotate(imread, cv2.ROTATE_90_CLOCKWISE)
+    imhash = cv2.img_hash.pHash(imread) # 8-byte hash
+    phash[1] = int.from_bytes(imhash.tobytes(), byteorder='big', signed=False)
+    imread = cv2.rotate(imread, cv2.ROTATE_180)
+    imhash = cv2.img_hash.pHash(imread) # 8-byte hash
+    phash[2] = int.from_bytes(imhash.tobytes(), byteorder='big', signed=False)
+    imread = cv2.rotate(imread, cv2.ROTATE_90_COUNTERCLOCKWISE)
+    imhash = cv2.img_hash.pHash(imread) # 8-byte hash
+    phash[3] = int.from_bytes(imhash.tobytes(), byteorder='big', signed=False)
+    return phash
+
+# Function to decode an image once, through the decoder for its format, and derive its
+# thumbnail, perceptual hashes, dimensions and colour histogram
+def compute_features(file_path):
+    image_format = sniff_format(file_path)
+    if image_format is None:
+        raise cv2.error("Unsupported image format " + file_path)
+    with stages.time('decode_' + image_format):
+        image, width, height = decoders[image_format](file_path)
+    if image is None:
+        raise cv2.error("Unable to decode " + file_path)
+    with stages.time('phash'):
+        thumbnail = cv2.resize(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), (thumbnail_size, thumbnail_size), interpolation=cv2.INTER_AREA)
+        histogram = np.concatenate([cv2.calcHist([image], [channel], None, [histogram_bins], [0, 256]).ravel() for channel in range(3)])
+        phash = rotation_hashes(cv2.resize(thumbnail, (32, 32), interpolation=cv2.INTER_AREA))
+    return {
+        'thumbnail': thumbnail,
+        'phash': phash,
+        'width': width,
+        'height': height,
+        'histogram': histogram / (image.shape[0] * image.shape[1])
+    }
+
+# Cache of image features keyed by the SHA-256 of the file, so a copy or a renamed file is never
+# decoded again. Records live in a memory-mapped file with a size cap, the slot and last use of
+# each hash live in the index database, and the least recently used record is evicted when full.
+class ThumbnailCache:
+    def __init__(self, db, path, max_bytes=cache_bytes, readonly=False):
+        self.db = db
+        self.readonly = readonly
+        self.max_bytes = max_bytes
+        self.capacity = max(1, max_bytes // entry.itemsize)
+        if not readonly:
+            self.db.execute("CREATE TABLE IF NOT EXISTS thumbnails (hash TEXT PRIMARY KEY, slot INTEGER UNIQUE, last_used INTEGER)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS thumbnails_last_used ON thumbnails (last_used)")
+            # Drop the records beyond a smaller size cap, the rest keep their slots
+            self.db.execute("DELETE FROM thumbnails WHERE slot >= ?", (self.capacity,))
+            self.db.commit()
+            with open(path, "ab") as f:
+                f.truncate(self.capacity * entry.itemsize)
+        self.entries = np.memmap(path, dtype=entry, mode='r' if readonly else 'r+', shape=(self.capacity,))
+
+    # Function to return the cached features of a file hash, None if they aren't cached
+    def lookup(self, file_hash):
+        row = self.db.execute("SELECT slot FROM thumbnails WHERE hash = ?", (file_hash,)).fetchone()
+        if row is None or row[0] >= self.capacity:
+            return None
+        record = self.entries[row[0]]
+        if record['hash'].tobytes() != bytes.fromhex(file_hash):
+            return None
+        return {
+            'thumbnail': np.array(record['thumbnail']),
+            'phash': {rotation: int(record['phash'][rotation]) for rotation in range(4)},
+            'width': int(record['width']),
+            'height': int(record['height']),
+            'histogram': np.array(record['histogram'])
+        }
+
+    # Function to mark the features of a file hash as recently used
+    def touch(self, file_hash):
+        self.db.execute("UPDATE thumbnails SET last_used = ? WHERE hash = ?", (time.time_ns(), file_hash))
+
+    # Function to store the features of a file hash, evicting the least recently used when full
+    def put(self, file_hash, features):
+        row = self.db.execute("SELECT slot FROM thumbnails WHERE hash = ?", (file_hash,)).fetchone()
+        if row is not None:
+            slot = row[0]
+        else:
+            count = self.db.execute("SELECT COUNT(*) FROM thumbnails").fetchone()[0]
+            if count < self.capacity:
+                slot = count
+            else:
+                slot = self.db.execute("SELECT slot FROM thumbnails ORDER BY last_used LIMIT 1").fetchone()[0]
+                self.db.execute("DELETE FROM thumbnails WHERE slot = ?", (slot,))
+        record = self.entries[slot]
+        record['hash'] = np.frombuffer(bytes.fromhex(file_hash), np.uint8)
+        record['thumbnail'] = features['thumbnail']
+        record['phash'] = [features['phash'][rotation] for rotation in range(4)]
+        record['width'] = features['width']
+        record['height'] = features['height']
+        record['histogram'] = features['histogram']
+        self.entries[slot] = record
+        self.db.execute("INSERT OR REPLACE INTO thumbnails VALUES (?, ?, ?)", (file_hash, slot, time.time_ns()))
+
+    # Function to return the features of a file, decoding it only when they aren't cached
+    def get(self, file_path, file_hash):
+        features = self.lookup(file_hash)
+        if features is None:
+            stages.increment('thumbnail_cache_misses')
+            features = compute_features(file_path)
+            self.put(file_hash, features)
+        else:
+            stages.increment('thumbnail_cache_hits')
+            self.touch(file_hash)
+        self.db.commit()
+        return features
+
+    def flush(self):
+        if not self.readonly:
+            self.entries.flush()